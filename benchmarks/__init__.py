@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# database and logger create their files under ~/mysite on import, keep benchmarks away from a real deployment
+os.environ["HOME"] = tempfile.mkdtemp()
+os.makedirs(os.path.join(os.environ["HOME"], "mysite"))
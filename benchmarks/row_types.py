@@ -0,0 +1,46 @@
+"""
+Times wrapping fetched rows of Database.get(include_column_names=True) into named tuples, with a row class created on
+every call against the one cached by Database._row_type.
+
+Run from the repository root: python -m benchmarks.row_types
+"""
+import timeit
+from collections import namedtuple
+import database as db
+
+
+RECALL_SELECT = "SELECT word_id, word, meaning FROM words"
+ROW_COUNTS = (1, 15, 1000)  # a single record, a recall or word page, a large export
+REPEAT = 5
+
+
+def per_call(rows):
+    """Row class built on every call, as Database.get did before."""
+    columns_part = RECALL_SELECT.split('FROM')[0].replace('SELECT', '').strip()
+    Row = namedtuple('Row', [col.strip() for col in columns_part.split(',')])
+    return [Row(*row) for row in rows]
+
+
+def cached(rows):
+    Row = db.Words._row_type(RECALL_SELECT)
+    return [Row._make(row) for row in rows]
+
+
+def best_us(function, number):
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1_000_000
+
+
+def main():
+    print(f"{'rows':>6} {'per call':>10} {'cached':>10}   us per get")
+    for count in ROW_COUNTS:
+        rows = [(i, f"word{i}", f"meaning of word {i}") for i in range(count)]
+        assert per_call(rows) == cached(rows)
+
+        number = max(10, 100_000 // count)
+        print(f"{count:>6} "
+              f"{best_us(lambda: per_call(rows), number):>10.2f} "
+              f"{best_us(lambda: cached(rows), number):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
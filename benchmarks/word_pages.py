@@ -0,0 +1,72 @@
+"""
+Times opening the last word page of large vocabularies, the default page of the words menu.
+
+Run from the repository root: python -m benchmarks.word_pages
+"""
+import timeit
+import database as db
+from bot._words import _split_into_pages, _render_page, _get_word_page_boundaries, _get_words_between
+from bot._vocabularies import word_page_index
+
+
+SIZES = (10_000, 100_000)
+REPEAT = 5
+
+
+def fill_vocabulary(user, words):
+    _, vocabulary_id = db.Vocabularies.add({"user_id": user, "vocabulary_name": f"{words} words"})
+    db.Words.add_bulk([{"user_id": user, "vocabulary_id": vocabulary_id, "word": f"word{i}",
+                        "meaning": f"meaning of word {i}" if i % 3 else None, "timestamp": i} for i in range(words)])
+    return vocabulary_id
+
+
+def all_words(user, vocabulary_id):
+    return db.Words.execute_query("SELECT word, meaning, word_id FROM words WHERE user_id = ? AND vocabulary_id = ? "
+                                  "ORDER BY word_id ASC;", (user, vocabulary_id))
+
+
+def eager(user, vocabulary_id):
+    """Every page split and kept in a list, then the last one joined."""
+    pages = list(_split_into_pages(all_words(user, vocabulary_id), True))
+    return "".join(word_line for _, word_line in pages[-1])
+
+
+def streamed(user, vocabulary_id, last_page):
+    """Pages before the last one only split, none of them kept."""
+    return _render_page(all_words(user, vocabulary_id), True, last_page)
+
+
+def indexed(user, vocabulary_id, version, cold):
+    """Page boundaries from word_page_index, only the words of the page fetched, as the words menu does."""
+    if cold:
+        word_page_index.clear()
+    pages = _get_word_page_boundaries(user, vocabulary_id, True, version)
+    return _render_page(_get_words_between(user, vocabulary_id, *pages[-1]), True)
+
+
+def best_ms(function, number):
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1000
+
+
+def main():
+    db.migrate()
+    db.Users.add({"user_id": 1, "username": "benchmark", "language": "en"})
+
+    print(f"{'words':>8} {'eager':>10} {'streamed':>10} {'index cold':>11} {'index warm':>11}   ms per last page")
+    for size in SIZES:
+        vocabulary_id = fill_vocabulary(1, size)
+        version = db.Vocabularies.get({"vocabulary_id": vocabulary_id}, include_column_names=True).version
+        last_page = len(_get_word_page_boundaries(1, vocabulary_id, True, version)) - 1
+        page = eager(1, vocabulary_id)
+        assert streamed(1, vocabulary_id, last_page) == page == indexed(1, vocabulary_id, version, cold=True)
+
+        number = max(1, 100_000 // size)
+        print(f"{size:>8} "
+              f"{best_ms(lambda: eager(1, vocabulary_id), number):>10.2f} "
+              f"{best_ms(lambda: streamed(1, vocabulary_id, last_page), number):>10.2f} "
+              f"{best_ms(lambda: indexed(1, vocabulary_id, version, cold=True), number):>11.2f} "
+              f"{best_ms(lambda: indexed(1, vocabulary_id, version, cold=False), 100):>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
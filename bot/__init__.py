@@ -1,20 +1,23 @@
 import json
+import threading
 import database as db
 import telepot
-from time import sleep
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from translations import translate, languages
 from ._enums import QUERY_ACTIONS, TEMP_KEYS, USER_STATES
 from .temp_manager import get_user, get_user_parameters, get_user_state, set_user_state, reset_user_state, get_temp, \
-    check_missing_setup
+    set_temp, remove_temp, check_missing_setup, invalidate_cached_parameters, invalidate_cached_temp, UpdateContext
 import bot._commands
 import bot._words
 import bot._reminders
 from ._vocabularies import create_vocabulary_start
 from ._settings import change_language_start, change_timezone_start
 from ._enums import QUERY_ACTIONS, TEMP_KEYS
+from .dispatcher import MessageDispatcher
+from .broadcasts import BroadcastManager
+from .dedup import UpdateDeduplicator
 from router import get_route
-from logger import setup_logger, thread_local, set_show_debug
+from logger import setup_logger, reset_debug_log, flush_debug_log, Lazy
 
 logger = setup_logger(__name__)
 PARSE_MODE = "HTML"
@@ -24,7 +27,12 @@ class Bot:
     def __init__(self, token):
         logger.info('Initializing bot...')
         self.bot = telepot.Bot(token)
+        self.dispatcher = MessageDispatcher()
+        self.broadcasts = BroadcastManager(self.deliver_message)
+        self.deduplicator = UpdateDeduplicator()
         self.users_data = {}
+        self.update_queries = {"updates": 0, "queries": 0, "max_queries": 0}  # database queries run by handle_update
+        self._update_queries_lock = threading.Lock()
 
     def __del__(self):
         logger.info('Deleting bot...')
@@ -32,6 +40,19 @@ class Bot:
     def __getattr__(self, name):
         return getattr(self.bot, name)
 
+    def record_update_queries(self, queries):
+        logger.debug("Update took %s database queries", queries)
+        with self._update_queries_lock:
+            self.update_queries["updates"] += 1
+            self.update_queries["queries"] += queries
+            self.update_queries["max_queries"] = max(self.update_queries["max_queries"], queries)
+
+    def update_stats(self):
+        with self._update_queries_lock:
+            stats = dict(self.update_queries)
+        stats["queries_per_update"] = stats["queries"] / stats["updates"] if stats["updates"] else 0.0
+        return stats
+
     @staticmethod
     def get_cancel_button(lang):
         """Create cancel button with inline keyboard."""
@@ -44,21 +65,27 @@ class Bot:
         """Manage the removal of old cancel buttons when a new one is sent."""
         old_cancel_button_id = None
         if delete_old:
-            old_cancel_button_id = db.Temp.get({'user_id': user, "key": TEMP_KEYS.CANCEL_BUTTON_ID.value},
-                                               include_column_names=True)
+            old_cancel_button_id = get_temp(user, TEMP_KEYS.CANCEL_BUTTON_ID.value)
             if old_cancel_button_id:
-                self.editMessageReplyMarkup((user, old_cancel_button_id.value), reply_markup=None)
+                self.dispatcher.submit(user, self.bot.editMessageReplyMarkup, (user, old_cancel_button_id),
+                                       reply_markup=None)
 
         if new_cancel_button_id:
-            db.Temp.add({"user_id": user, "key": TEMP_KEYS.CANCEL_BUTTON_ID.value, "value": new_cancel_button_id})
+            set_temp(user, TEMP_KEYS.CANCEL_BUTTON_ID.value, new_cancel_button_id)
         elif old_cancel_button_id:
-            db.Temp.delete({"user_id": user, "key": TEMP_KEYS.CANCEL_BUTTON_ID.value})
+            remove_temp(user, TEMP_KEYS.CANCEL_BUTTON_ID.value)
 
     def deliver_message(self, user, text, add_cancel_button=False, lang="", reply_to_msg_id=None, reply_markup=None):
-        """Deliver a message to a user with optional cancel button and reply markup."""
+        """
+        Queue a message to a user with optional cancel button and reply markup. Returns a future of the sent message,
+        or None if there is nothing to send. Never waits for the message to be sent: message_id of a cancel button is
+        stored once it is, in a transaction of its own.
+        """
         if text == "":
             return
-        logger.debug(f"Sending message with parameters: {locals()}")  # Logs all parameters
+        logger.debug("Sending message with parameters: %s", dict(
+            user=user, text=text, add_cancel_button=add_cancel_button, lang=lang, reply_to_msg_id=reply_to_msg_id,
+            reply_markup=reply_markup))
 
         if reply_markup:
             final_reply_markup = reply_markup
@@ -67,43 +94,37 @@ class Bot:
         else:
             final_reply_markup = {'remove_keyboard': True}
 
-        response = self.sendMessage(user, text, reply_to_message_id=reply_to_msg_id, reply_markup=final_reply_markup,
-                                    parse_mode=PARSE_MODE)
-
-        logger.debug("Sent message: {}".format(response))
+        future = self.dispatcher.submit(user, self.bot.sendMessage, user, text, reply_to_message_id=reply_to_msg_id,
+                                        reply_markup=final_reply_markup, parse_mode=PARSE_MODE)
 
         if add_cancel_button:
-            self.manage_cancel_buttons(user, response.get('message_id'), delete_old=False)  # old deleted in get_user
+            future.add_done_callback(lambda sent: self._store_cancel_button(user, sent))
+        return future
+
+    def _store_cancel_button(self, user, future):
+        """
+        Done callback of a message with cancel button, runs in a dispatcher worker. If the user's next update is
+        processed before the message is sent, that update can't remove the button yet, the one after it does.
+        """
+        if future.cancelled() or future.exception() is not None:
+            return  # logged by the dispatcher
+        response = future.result()
+        logger.debug("Sent message: %s", response)
+        try:
+            with db.Database.transaction():
+                self.manage_cancel_buttons(user, response.get('message_id'), delete_old=False)  # old deleted by update
+        except Exception as e:
+            logger.error(f"Couldn't store cancel button of user {user}: {e}", exc_info=True)
 
     def broadcast(self, text: str, reply_markup=None, exceptions=None):
+        """Starts a broadcast job sending text to all users except exceptions. Returns its job_id."""
         logger.info("Broadcasting message: {}".format(text))
-        exceptions = exceptions or []
-        logger.info(f"Found {len(exceptions)} exceptions")
-        users = db.Users.execute_query("SELECT user_id FROM users;")
-        msg_count = 0
-        for user in users:
-            if user[0] in exceptions:
-                continue
-            self.deliver_message(user[0], text, reply_markup=reply_markup)
-            msg_count += 1
-            if msg_count > 0 and msg_count % 30 == 0:  # Telegram allows 30 messages per second
-                sleep(1)
-        logger.info(f"Sent to {len(users)} users")
+        return self.broadcasts.start(text, reply_markup, exceptions)
 
     def broadcast_multilang(self, text: dict, reply_markup=None, exceptions=None):
+        """Starts a broadcast job sending every user text in their language. Returns its job_id."""
         logger.info("Broadcasting message: {}".format(text))
-        exceptions = exceptions or []
-        logger.info(f"Found {len(exceptions)} exceptions")
-        users = db.Users.execute_query("SELECT user_id, language FROM users;")
-        msg_count = 0
-        for user, lang in users:
-            if user[0] in exceptions:
-                continue
-            self.deliver_message(user, text[lang], reply_markup=reply_markup)
-            msg_count += 1
-            if msg_count > 0 and msg_count % 30 == 0:  # Telegram allows 30 messages per second
-                sleep(1)
-        logger.info(f"Sent to {len(users)} users")
+        return self.broadcasts.start(text, reply_markup, exceptions)
 
     @staticmethod
     def is_allowed_update(missing, trigger, state, query_action, command):
@@ -190,23 +211,24 @@ class Bot:
             - Executes the provided function if no specific action is required.
         """
         # not answering callback query leads to long waiting animation, but some actions don't require it
+        # queued like messages, so the update never waits for Telegram while its transaction holds the writer
         if callback_query_id and answer_callback_query and action not in {"edit", "edit_markup",
                                                                           "popup",  # answers it later
                                                                           "multi_action"}:  # inner call will answer
-            self.answerCallbackQuery(callback_query_id)
+            self.dispatcher.submit(user, self.bot.answerCallbackQuery, callback_query_id)
 
-        logger.debug(f"Executing action: {action} for user: {user}")
+        logger.debug("Executing action: %s for user: %s", action, user)
         result = function(update) if function else None
 
         match action:
             case "send":
                 if add_cancel_button:
                     text, lang = result if result else (text, lang)
-                    logger.debug(f"Sending text: {text} with cancel button in: {lang} to user {user}")
+                    logger.debug("Sending text: %s with cancel button in: %s to user %s", text, lang, user)
                     self.deliver_message(user, text, add_cancel_button=True, lang=lang)
                 else:
                     text, reply_markup = result if result else (text, reply_markup)
-                    logger.debug(f"Sending text: {text} with markup: {reply_markup} to user {user}")
+                    logger.debug("Sending text: %s with markup: %s to user %s", text, reply_markup, user)
                     self.deliver_message(user, text, reply_markup=reply_markup)
 
             case "edit":
@@ -214,31 +236,34 @@ class Bot:
                     raise ValueError("Missing parameter: msg_id for editing message")
 
                 text, reply_markup = result if result else (text, reply_markup)
-                logger.debug(f"Editing text: {text} and markup: {reply_markup} to user {user} on msg_id: {msg_id}")
-                self.editMessageText((user, msg_id), text, parse_mode="HTML", reply_markup=reply_markup)
+                logger.debug("Editing text: %s and markup: %s to user %s on msg_id: %s", text, reply_markup, user,
+                             msg_id)
+                self.dispatcher.submit(user, self.bot.editMessageText, (user, msg_id), text, parse_mode="HTML",
+                                       reply_markup=reply_markup)
 
             case "edit_markup":
                 if not msg_id:
                     raise ValueError("Missing parameter: msg_id for editing reply markup")
 
                 reply_markup = result if result else reply_markup
-                logger.debug(f"Editing markup: {reply_markup} to user {user} on msg_id: {msg_id}")
-                self.editMessageReplyMarkup((user, msg_id), reply_markup=reply_markup)
+                logger.debug("Editing markup: %s to user %s on msg_id: %s", reply_markup, user, msg_id)
+                self.dispatcher.submit(user, self.bot.editMessageReplyMarkup, (user, msg_id), reply_markup=reply_markup)
 
             case "popup":
                 if not callback_query_id:
                     raise ValueError("Missing parameter: callback_query_id for popup action")
 
                 popup_text = result if result else text
-                logger.debug(f"Showing popup: {popup_text} to user {user}")
-                self.answerCallbackQuery(callback_query_id, text=popup_text, show_alert=True)
+                logger.debug("Showing popup: %s to user %s", popup_text, user)
+                self.dispatcher.submit(user, self.bot.answerCallbackQuery, callback_query_id, text=popup_text,
+                                       show_alert=True)
 
             case "multi_action":
                 if inner:
                     raise RecursionError("Nested multi_action calls are not allowed")
                 if not isinstance(result, list):
                     raise TypeError(f"multi_action must return a list of dicts, got {type(result).__name__} instead.")
-                logger.debug(f"Multiple actions: {result}")
+                logger.debug("Multiple actions: %s", result)
                 for item in result:
                     if not isinstance(item, dict):
                         raise TypeError(f"Each multi_action entry must be a dict, got {type(item).__name__}.")
@@ -254,91 +279,65 @@ class Bot:
     def handle_update(self, update):
         user = None
         try:
-            thread_local.debug_log_stack = []  # reset log stack to have logs only from the current update
+            reset_debug_log()  # to have logs only from the current update
 
             # pretty print logs
-            logger.debug('Received update: {}'.format(json.dumps(update, indent=4, ensure_ascii=False)))
+            logger.debug('Received update: %s', Lazy(json.dumps, update, indent=4, ensure_ascii=False))
+
+            db.Database.connection.reset_query_count()
+            if self.deduplicator.is_duplicate(update):
+                return
 
             user = get_user(update)
-            self.manage_cancel_buttons(user)
-
-            callback_query_id = None
-            trigger = None
-            command = None
-            state = None
-            query_action = None
-            msg_id = None
-            if "message" in update:
-                if "text" in update["message"]:
-                    text = update["message"]["text"]
-                    trigger = "text"
-
-                    if text.startswith("/"):
-                        command = text.split()[0].lower()
-                        command = command if command in {"/start", "/menu", "/help"} else "default"
-                        reset_user_state(user)
-                    else:
-                        state = get_user_state(user)
+            context = UpdateContext(update)
+            with db.Database.transaction():  # one commit per update, nothing is written if it fails
+                self.manage_cancel_buttons(user)
+
+                if context.trigger == "text" and not context.command:
+                    context.state = get_user_state(user)
                 else:
-                    trigger = "other"
                     reset_user_state(user)
 
-            elif "callback_query" in update:
-                trigger = "callback_query"
-                query_action = json.loads(update["callback_query"]["data"])[0]
-                msg_id = update["callback_query"]["message"]["message_id"]
-                callback_query_id = update["callback_query"]["id"]
-                reset_user_state(user)
-
-            elif "my_chat_member" in update:
-                trigger = "chat_member"
-                reset_user_state(user)
-
-            was_missing = check_missing_setup(user)
-            logger.debug(f"User {user} has missing setup before update: {was_missing}")
-            allowed = self.is_allowed_update(was_missing, trigger, state, query_action, command)
-            logger.debug("Update allowed" if allowed else "Update not allowed")
-
-            if not allowed:
-                params = get_user_parameters(user)
-                if len(params) > 0:
-                    lang = params.language
-                    if lang in languages:
-                        self.deliver_message(user, translate(lang, "finish_setup"))
-                self.set_up(was_missing, update)
-                return
+                was_missing = context.missing_setup = check_missing_setup(user)
+                logger.debug("User %s has missing setup before update: %s", user, was_missing)
+                allowed = self.is_allowed_update(was_missing, context.trigger, context.state, context.query_action,
+                                                 context.command)
+                logger.debug("Update allowed" if allowed else "Update not allowed")
 
-            function, action, cancel_button = get_route(trigger, state, query_action, command)
-            self.execute_action(user, action, function, update, callback_query_id, msg_id,
-                                add_cancel_button=cancel_button)
-
-            if was_missing:
-                is_missing = check_missing_setup(user)
-                logger.debug(f"User {user} has missing setup after update: {is_missing}")
-                if all((
-                    is_missing in {"lang", "vocabulary", "timezone"},
-                    query_action != QUERY_ACTIONS.PICK_TIME.value,  # picking time is not a finished action
-                    trigger != "chat_member",  # texting a user who blocked bot is pointless
-                )):
-                    self.set_up(is_missing, update)
-                elif is_missing is None:  # something was missing and now nothing is
-                    lang = get_user_parameters(user).language
-                    self.deliver_message(user, translate(lang, "setup_finished"))
+                if not allowed:
+                    params = context.parameters
+                    if len(params) > 0:
+                        lang = params.language
+                        if lang in languages:
+                            self.deliver_message(user, translate(lang, "finish_setup"))
+                    self.set_up(was_missing, context)
+                    return
+
+                function, action, cancel_button = get_route(context.trigger, context.state, context.query_action,
+                                                            context.command)
+                self.execute_action(user, action, function, context, context.callback_query_id, context.msg_id,
+                                    add_cancel_button=cancel_button)
+
+                if was_missing:
+                    is_missing = check_missing_setup(user)
+                    logger.debug("User %s has missing setup after update: %s", user, is_missing)
+                    if all((
+                        is_missing in {"lang", "vocabulary", "timezone"},
+                        context.query_action != QUERY_ACTIONS.PICK_TIME.value,  # picking time is not a finished action
+                        context.trigger != "chat_member",  # texting a user who blocked bot is pointless
+                    )):
+                        self.set_up(is_missing, context)
+                    elif is_missing is None:  # something was missing and now nothing is
+                        lang = context.parameters.language
+                        self.deliver_message(user, translate(lang, "setup_finished"))
 
         except Exception as e:
-            set_show_debug(True)
-
-            # Flush debug logs for this update
-            if hasattr(thread_local, "debug_log_stack"):
-                logger.debug("Debug log stack before crash:")
-                while thread_local.debug_log_stack:
-                    logger.debug(thread_local.debug_log_stack.pop(0))  # Log and remove each debug entry
-                del thread_local.debug_log_stack  # Clear the stack
-
+            flush_debug_log(logger)  # debug logs of this update
             logger.critical(f"Couldn't process update: {e}", exc_info=True)
-            set_show_debug(False)
 
             if user:
+                invalidate_cached_parameters(user)  # caches may hold values of the rolled back transaction
+                invalidate_cached_temp(user)
                 try:
                     params = get_user_parameters(user)
                     if len(params) > 0:
@@ -348,3 +347,6 @@ class Bot:
                     logger.critical(f"Couldn't notify user {user} about error: {e_}")
                 else:
                     logger.info(f"User {user} has been notified about error")
+
+        finally:
+            self.record_update_queries(db.Database.connection.query_count)
@@ -2,9 +2,10 @@ from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import database as db
 from translations import translate
 from .temp_manager import get_user, get_user_parameters, reset_user_state, set_temp, invalidate_cached_parameters, \
-    check_missing_setup
+    invalidate_cached_temp, check_missing_setup, get_callback_data
 import json
 from ._enums import QUERY_ACTIONS, TEMP_KEYS
+from ._vocabularies import invalidate_cached_word_pages
 from router import route
 from logger import setup_logger
 
@@ -33,8 +34,9 @@ def start(update):
         username = ':' + first_name.lower() + ":" + last_name.lower() + ':'
 
     if db.Users.add({"user_id": user, "username": username})[0]:
+        invalidate_cached_parameters(user)
         logger.info(f"New user added: {username} - {user}")
-        set_temp(user, TEMP_KEYS.TIMEZONE_NOT_SET.value, 1)
+        set_temp(user, TEMP_KEYS.TIMEZONE_NOT_SET.value, 1, ttl=None)  # setup marker, must outlive any flow
 
     if check_missing_setup(user) is None:
         return help_(update)
@@ -47,7 +49,7 @@ def start(update):
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.MENU.value, action="edit")
 def menu(update):
     user = get_user(update)
-    logger.debug(f'Constructing menu page for user: {user}')
+    logger.debug('Constructing menu page for user: %s', user)
     parameters = get_user_parameters(user)
     lang = parameters.language
 
@@ -87,7 +89,7 @@ def show_info(update):
     parameters = get_user_parameters(user)
     lang = parameters.language
 
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     key, back_button_action = callback_data[1:]
     text = translate(lang, key)
     reply_markup = InlineKeyboardMarkup(inline_keyboard=[
@@ -135,6 +137,8 @@ def handle_chat_member_status(update):
         logger.info(f"User {user} has blocked the bot")
         db.Users.delete({"user_id": user})  # all data is linked to user_id and will be deleted too
         invalidate_cached_parameters(user)
+        invalidate_cached_temp(user)
+        invalidate_cached_word_pages(user)
         logger.info(f"All records of {user} have been deleted")
     elif old_status == "kicked" and new_status == "member":
         logger.info(f"User {user} has unblocked the bot")
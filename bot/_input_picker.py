@@ -27,7 +27,7 @@ def pick_time(update, time=None, include_minutes=None, next_query_action=None, b
     lang = parameters.language
 
     if all((not time, not next_query_action, not back_button_action)):
-        callback_data = json.loads(update["callback_query"]["data"])
+        callback_data = get_callback_data(update)
         time, include_minutes, next_query_action, back_button_action, real_time_mins, adjust_to_timezone = callback_data[1:]
     timezone = parameters.timezone if adjust_to_timezone else 0
 
@@ -77,22 +77,23 @@ def _adjust_reminders_to_new_timezone(user, old_timezone, new_timezone):
     offset_difference = old_timezone - new_timezone
     vocabularies = _get_vocabulary_list(user)
 
-    for vocabulary_id in vocabularies:
-        reminders = _get_reminder_list(user, vocabulary_id)
-
-        for time, number_of_words in reminders.items():
-            new_time = shift_time(time, hour_offset=offset_difference)
-
-            db.Reminders.set(
-                conditions={
-                    "user_id": user,
-                    "vocabulary_id": vocabulary_id,
-                    "time": time,
-                },
-                new_values={
-                    "time": new_time,
-                }
-            )
+    with db.Database.transaction():  # all reminders are shifted or none
+        for vocabulary_id in vocabularies:
+            reminders = _get_reminder_list(user, vocabulary_id)
+
+            for time, number_of_words in reminders.items():
+                new_time = shift_time(time, hour_offset=offset_difference)
+
+                db.Reminders.set(
+                    conditions={
+                        "user_id": user,
+                        "vocabulary_id": vocabulary_id,
+                        "time": time,
+                    },
+                    new_values={
+                        "time": new_time,
+                    }
+                )
 
 
 def _get_reminders_list_at(time: str) -> list[tuple[int, int, int, str, int]]:
@@ -238,7 +239,7 @@ def add_reminder_vocabulary_chosen(update):
     parameters = get_user_parameters(user)
     lang = parameters.language
     timezone = parameters.timezone
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     vocabulary_id = callback_data[1]
     vocabulary_name = _get_vocabulary_name(vocabulary_id)
     set_temp(user, TEMP_KEYS.VOCABULARY.value, vocabulary_id)
@@ -258,7 +259,7 @@ def add_reminder_vocabulary_chosen(update):
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.ADD_REMINDER_TIME_CHOSEN.value, action="edit")
 def add_reminder_time_chosen(update):
     user = get_user(update)
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     time = callback_data[1]
     set_temp(user, TEMP_KEYS.TIME.value, time)
 
@@ -281,7 +282,7 @@ def add_reminder_finalize(update):
     vocabulary_id = pop_temp(user, TEMP_KEYS.VOCABULARY.value)
     vocabulary_name = _get_vocabulary_name(vocabulary_id)
 
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     number_of_words = callback_data[1]
 
     reminder_id = _add_reminder(user, vocabulary_id, time, number_of_words)
@@ -338,7 +339,7 @@ def delete_reminder_vocabulary_chosen(update):
     parameters = get_user_parameters(user)
     lang = parameters.language
     timezone = parameters.timezone
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     vocabulary_id = callback_data[1]
     vocabulary_name = _get_vocabulary_name(vocabulary_id)
 
@@ -357,7 +358,7 @@ def delete_reminder_finalize(update):
     parameters = get_user_parameters(user)
     lang = parameters.language
     timezone = parameters.timezone
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     vocabulary_id, time = callback_data[1:]
     vocabulary_name = _get_vocabulary_name(vocabulary_id)
     match _delete_reminder(user, vocabulary_id=vocabulary_id, time=time):
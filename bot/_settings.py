@@ -1,7 +1,7 @@
 import database as db
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import json
-from .temp_manager import get_user, get_user_parameters, invalidate_cached_parameters, remove_temp
+from .temp_manager import get_user, get_user_parameters, invalidate_cached_parameters, remove_temp, get_callback_data
 from ._enums import QUERY_ACTIONS, TEMP_KEYS
 from .utils import html_wrapper, escape_html, get_hh_mm, calculate_timezone_offset
 from ._input_picker import pick_time
@@ -119,7 +119,7 @@ def change_language_start(update, return_to_menu=True):
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.LANGUAGE_CHOSEN.value, action="edit")
 def change_language_finalize(update):
     user = get_user(update)
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     lang, return_to_menu = callback_data[1:]
 
     if lang not in languages:
@@ -158,7 +158,7 @@ def change_timezone_finalize(update):
     user = get_user(update)
     parameters = get_user_parameters(user)
     old_timezone = parameters.timezone
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     time = callback_data[1]
     logger.info(f"User {user} chose their local time as: {time}")
     new_timezone = calculate_timezone_offset(time)
@@ -174,7 +174,7 @@ def set_up_timezone_finalize(update):
     old_timezone = parameters.timezone
     lang = parameters.language
 
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     time = callback_data[1]
     logger.info(f"User {user} set up their local time as: {time}")
     new_timezone = calculate_timezone_offset(time)
@@ -1,8 +1,10 @@
 import json
+import sys
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from .temp_manager import *
 from ._enums import TaskStatus, QUERY_ACTIONS, TEMP_KEYS, USER_STATES
 from .utils import html_wrapper, escape_html
+from .cache import LRUCache
 from translations import translate, conjugate_word
 from router import route
 from logger import setup_logger
@@ -10,6 +12,28 @@ from logger import setup_logger
 logger = setup_logger(__name__)
 
 
+MAX_CACHED_PAGE_INDEXES = 1000
+MAX_CACHED_WORD_PAGES = 2000
+
+# word pages of vocabularies, built in _words. Keys start with (user, vocabulary_id) and end with the vocabulary
+# version, so entries of a changed vocabulary are never hit again, and entries of a deleted one are removed
+# {(user, vocabulary_id, hide_meaning, vocabulary version): [(first_word_id, last_word_id) of every page]}
+word_page_index = LRUCache(MAX_CACHED_PAGE_INDEXES,
+                           sizeof=lambda value: sys.getsizeof(value) + len(value) * sys.getsizeof((0, 0)))
+# {(user, vocabulary_id, page, hide_meaning, lang, vocabulary version): (text, keyboard)}
+rendered_word_pages = LRUCache(MAX_CACHED_WORD_PAGES,
+                               sizeof=lambda value: sys.getsizeof(value[0]) + sys.getsizeof(json.dumps(value[1])))
+
+
+def invalidate_cached_word_pages(user, vocabulary_id=None):
+    """Removes cached word pages of the vocabulary, or of all vocabularies of the user if vocabulary_id isn't given."""
+    def matches(key):
+        return key[0] == user and (vocabulary_id is None or key[1] == vocabulary_id)
+
+    word_page_index.invalidate_where(matches)
+    rendered_word_pages.invalidate_where(matches)
+
+
 ####################################################################################################################
 #                                                DATABASE INTERACTIONS
 ####################################################################################################################
@@ -51,12 +75,24 @@ def _delete_vocabulary(user, vocabulary_id=None, vocabulary_name=None):
     if result:
         logger.info(f"User {user} deleted vocabulary #{vocabulary_id}")
         invalidate_cached_parameters(user)
+        invalidate_cached_word_pages(user, vocabulary_id)
 
     if result:
         return TaskStatus.SUCCESS
     return TaskStatus.FAILURE
 
 
+def _get_vocabulary_overview(user):
+    """
+    Fetches vocabularies of a user together with their word counts in one query.
+
+    :param user: The user ID to fetch vocabularies for.
+    :return: A list of named tuples (vocabulary_id, vocabulary_name, word_count) ordered by creation.
+    """
+    return db.Vocabularies.get({"user_id": user}, order_by="vocabulary_id", force_2d=True, include_column_names=True,
+                               custom_select="SELECT vocabulary_id, vocabulary_name, word_count FROM vocabularies")
+
+
 def _get_vocabulary_list(user):
     """
     Fetches vocabularies for a user and returns a dictionary mapping vocabulary_id to vocabulary_name.
@@ -64,12 +100,7 @@ def _get_vocabulary_list(user):
     :param user: The user ID to fetch vocabularies for.
     :return: A dictionary {vocabulary_id: vocabulary_name}.
     """
-    vocabularies = db.Vocabularies.get({"user_id": user}, force_2d=True, include_column_names=True)
-
-    if vocabularies:
-        return {vocabulary.vocabulary_id: vocabulary.vocabulary_name for vocabulary in vocabularies}
-    else:
-        return {}
+    return {vocabulary.vocabulary_id: vocabulary.vocabulary_name for vocabulary in _get_vocabulary_overview(user)}
 
 
 def _get_vocabulary_name(vocabulary_id):
@@ -79,6 +110,18 @@ def _get_vocabulary_name(vocabulary_id):
     return None
 
 
+def _get_vocabulary_info(vocabulary_id):
+    """
+    Fetches name, number of words and version of the vocabulary. The version changes whenever its word list changes.
+
+    :param vocabulary_id: The ID of the vocabulary.
+    :return: A named tuple (vocabulary_name, word_count, version) or None if the vocabulary doesn't exist.
+    """
+    entry = db.Vocabularies.get({"vocabulary_id": vocabulary_id}, include_column_names=True,
+                                custom_select="SELECT vocabulary_name, word_count, version FROM vocabularies")
+    return entry or None
+
+
 def _get_vocabulary_id(user, vocabulary_name):
     entry = db.Vocabularies.get({"user_id": user, "vocabulary_name": vocabulary_name},
                                 include_column_names=True)
@@ -88,7 +131,10 @@ def _get_vocabulary_id(user, vocabulary_name):
 
 
 def _count_words(vocabulary_id):
-    return db.Words.count_where({"vocabulary_id": vocabulary_id})
+    """Returns the number of words in the vocabulary, kept up to date by database triggers."""
+    entry = db.Vocabularies.get({"vocabulary_id": vocabulary_id},
+                                custom_select="SELECT word_count FROM vocabularies")
+    return entry[0] if entry else 0
 
 ####################################################################################################################
 #                                                     OTHER
@@ -158,7 +204,7 @@ def change_vocabulary_start(update, next_query_action=QUERY_ACTIONS.VOCABULARY_C
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.VOCABULARY_CHOSEN.value, action="edit")
 def change_vocabulary_finish(update):
     user = get_user(update)
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     vocabulary_id = callback_data[1]
     _set_current_vocabulary(user, vocabulary_id)
     return construct_vocabulary_page(update)
@@ -172,7 +218,7 @@ def create_vocabulary_start(update):
     :return: text to be sent to user and language of cancel button. Should be sent with cancel button
     """
     user = get_user(update)
-    logger.debug(f"User {user} initiated vocabulary creation")
+    logger.debug("User %s initiated vocabulary creation", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
 
@@ -190,7 +236,7 @@ def create_vocabulary_finalize(update):
     """
     user = get_user(update)
     text = update["message"]["text"]
-    logger.debug(f"User {user} is trying to create vocabulary '{text}'")
+    logger.debug("User %s is trying to create vocabulary '%s'", user, text)
     parameters = get_user_parameters(user)
     lang = parameters.language
     vocabulary_name = text
@@ -216,7 +262,7 @@ def delete_vocabulary_start(update):
     :return: text to be sent to user and language of cancel button. Should be sent with cancel button
     """
     user = get_user(update)
-    logger.debug(f"User {user} initiated word deletion")
+    logger.debug("User %s initiated word deletion", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
 
@@ -234,7 +280,7 @@ def delete_vocabulary_input(update):
     """
     user = get_user(update)
     text = update["message"]["text"]
-    logger.debug(f"User {user} provided a word for deletion")
+    logger.debug("User %s provided a word for deletion", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
     vocabulary_name = text
@@ -270,7 +316,7 @@ def delete_vocabulary_confirmed(update):
     :return: text, reply_markup to be sent to user
     """
     user = get_user(update)
-    logger.debug(f"User {user} confirmed vocabulary deletion")
+    logger.debug("User %s confirmed vocabulary deletion", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
     vocabulary_id = pop_temp(user, TEMP_KEYS.VOCABULARY.value)
@@ -315,7 +361,7 @@ def delete_vocabulary_declined(update):
     :return: text, reply_markup to be sent to user
     """
     user = get_user(update)
-    logger.debug(f"User {user} cancelled vocabulary deletion")
+    logger.debug("User %s cancelled vocabulary deletion", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
     text = translate(lang, "vocabulary_deletion_cancelled")
@@ -331,8 +377,7 @@ def construct_vocabulary_page(update):
     parameters = get_user_parameters(user)
     lang = parameters.language
     current_vocabulary_id = parameters.current_vocabulary_id
-    vocabularies = _get_vocabulary_list(user)
-    current_vocabulary_name = vocabularies[current_vocabulary_id]
+    vocabularies = _get_vocabulary_overview(user)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -361,10 +406,11 @@ def construct_vocabulary_page(update):
     text = ""
 
     values = []
-    for vocabulary_id in vocabularies:
-        word_count = _count_words(vocabulary_id)
-        vocabulary_name = vocabularies[vocabulary_id]
-        values.append((vocabulary_name, word_count))
+    current_vocabulary_name = None
+    for vocabulary in vocabularies:
+        if vocabulary.vocabulary_id == current_vocabulary_id:
+            current_vocabulary_name = vocabulary.vocabulary_name
+        values.append((vocabulary.vocabulary_name, vocabulary.word_count))
 
     if not values:
         raise RuntimeError("No vocabularies found, so update shouldn't have been processed")
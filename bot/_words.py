@@ -1,10 +1,12 @@
 import json
+from itertools import islice
 import database as db
 from . import QUERY_ACTIONS, get_user, get_user_parameters
 from ._commands import logger
 from .temp_manager import get_user, get_user_parameters, set_user_state, reset_user_state, set_temp, pop_temp, get_temp, \
-    remove_temp
-from ._vocabularies import _get_vocabulary_name, change_vocabulary_start, _set_current_vocabulary, _count_words
+    remove_temp, get_callback_data
+from ._vocabularies import _get_vocabulary_name, change_vocabulary_start, _set_current_vocabulary, _count_words, \
+    _get_vocabulary_info, word_page_index, rendered_word_pages
 from .utils import html_wrapper, escape_html, get_timestamp, pad
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 from ._enums import TaskStatus, QUERY_ACTIONS, TEMP_KEYS, USER_STATES
@@ -85,11 +87,39 @@ def _get_word_meaning(word_id=None, user=None, vocabulary_id=None, word=None):
     return None
 
 
-def _get_user_words(user, vocabulary_id, include_timestamp=False, reverse=False):
-    select = "SELECT word, meaning, timestamp FROM words" if include_timestamp else "SELECT word, meaning FROM words"
-    order = "DESC" if reverse else "ASC"
-    return db.Words.get({"user_id": user, "vocabulary_id": vocabulary_id}, custom_select=select,
-                        order_by="word_id", sort_direction=order, force_2d=True)
+def _get_words_between(user, vocabulary_id, first_word_id, last_word_id):
+    """Fetches words of the vocabulary with word_id in the given range, ordered by word_id."""
+    return db.Words.execute_query("""
+    SELECT word, meaning FROM words
+    WHERE user_id = ? AND vocabulary_id = ? AND word_id BETWEEN ? AND ?
+    ORDER BY word_id ASC;
+    """, (user, vocabulary_id, first_word_id, last_word_id))
+
+
+def _get_word_page_boundaries(user, vocabulary_id, hide_meaning, version):
+    """
+    Returns (first_word_id, last_word_id) of every word page of the vocabulary, so a page can be fetched by its word_id
+    range. Page size depends on the length of every word, so boundaries are computed with one pass over the
+    vocabulary and cached until its version changes.
+
+    :param user: The ID of the user.
+    :param vocabulary_id: The ID of the vocabulary.
+    :param hide_meaning: Whether meanings are hidden, which affects the length of pages.
+    :param version: Current version of the vocabulary.
+    :return: A list of (first_word_id, last_word_id) tuples, one per page.
+    """
+    key = (user, vocabulary_id, bool(hide_meaning), version)  # the query filters by user, so must the key
+    cached = word_page_index.get(key)
+    if cached is not None:
+        return cached
+
+    rows = db.Words.iter_query("SELECT word, meaning, word_id FROM words WHERE user_id = ? AND vocabulary_id = ? "
+                               "ORDER BY word_id ASC;", (user, vocabulary_id))
+    boundaries = [(page[0][0][2], page[-1][0][2]) for page in _split_into_pages(rows, hide_meaning)]
+
+    if not db.Database.connection.holds_writer:  # uncommitted changes may still be rolled back, don't cache them
+        word_page_index.set(key, boundaries)
+    return boundaries
 
 
 def _get_old_words(user: int, vocabulary_id: int, limit: int) -> list[tuple[str, str]]:
@@ -104,33 +134,29 @@ def _get_old_words(user: int, vocabulary_id: int, limit: int) -> list[tuple[str,
     """
     current_timestamp = get_timestamp()
 
-    words = db.Words.get(
-        conditions={
-            "user_id": user,
-            "vocabulary_id": vocabulary_id
-        },
-        limit=limit,
-        order_by="timestamp",
-        sort_direction="ASC",
-        custom_select="SELECT word, meaning FROM words",
-        force_2d=True,
-        include_column_names=True
-    )
-
-    word_list = [(word.word, word.meaning) for word in words]
-
-    for word in words:
-        db.Words.set(
+    with db.Database.transaction():  # one commit for the whole recall, also when called outside of an update
+        words = db.Words.get(
             conditions={
                 "user_id": user,
-                "vocabulary_id": vocabulary_id,
-                "word": word.word
+                "vocabulary_id": vocabulary_id
             },
-            new_values={
-                "timestamp": current_timestamp
-            }
+            limit=limit,
+            order_by="timestamp",
+            sort_direction="ASC",
+            custom_select="SELECT word_id, word, meaning FROM words",
+            force_2d=True,
+            include_column_names=True
         )
 
+        word_list = [(word.word, word.meaning) for word in words]
+
+        if words:
+            # touch all fetched words with one statement instead of an UPDATE (and a commit) per word
+            word_ids = [word.word_id for word in words]
+            placeholders = ', '.join('?' * len(word_ids))
+            db.Words.execute_query(f"UPDATE words SET timestamp = ? WHERE word_id IN ({placeholders});",
+                                   (current_timestamp, *word_ids))
+
     return word_list
 
 
@@ -139,49 +165,67 @@ def _get_old_words(user: int, vocabulary_id: int, limit: int) -> list[tuple[str,
 ####################################################################################################################
 
 
-def _word_list_to_pages(values: list[tuple[str, str]], hide_meaning: bool, max_length: int = MAX_MESSAGE_LENGTH - 50,
-                        words_limit: int = WORDS_PER_PAGE) -> list[str]:
+def _word_line(word: str, definition: str, meaning_wrapper: str) -> str:
+    if definition:
+        word_line = (
+            f"{html_wrapper(escape_html(word), 'code')}  —  "
+            f"{html_wrapper(escape_html(definition), meaning_wrapper)}\n"
+        )
+    else:
+        word_line = f"{html_wrapper(escape_html(word), 'code')}\n"
+
+    return word_line + '-------------------------------------------------------------\n'
+
+
+def _split_into_pages(values, hide_meaning: bool, max_length: int = MAX_MESSAGE_LENGTH - 50,
+                      words_limit: int = WORDS_PER_PAGE):
     """
-    Splits a list of word-definition pairs into pages based on max length and word limits.
+    Splits rows starting with word and definition into pages based on max length and word limits.
 
-    :param values: List of tuples containing word and definition.
+    :param values: Iterable of rows, where the first two values are word and definition.
     :param hide_meaning: Boolean indicating whether to hide the meaning with a spoiler format.
     :param max_length: Maximum character length for each page.
     :param words_limit: Maximum number of words per page.
-    :return: List of pages as strings.
+    :return: Generator of pages, each a list of (row, word_line) tuples.
     """
     meaning_wrapper = "tg-spoiler" if hide_meaning else ""
-    pages = []
-    current_page = ""
-    current_words_count = 0
-
-    for index, (word, definition) in enumerate(values):
-        if definition:
-            word_line = (
-                f"{html_wrapper(escape_html(word), 'code')}  —  "
-                f"{html_wrapper(escape_html(definition), meaning_wrapper)}\n"
-            )
-        else:
-            word_line = f"{html_wrapper(escape_html(word), 'code')}\n"
+    current_page = []
+    current_length = 0
 
-        word_line += '-------------------------------------------------------------\n'
+    for row in values:
+        word_line = _word_line(row[0], row[1], meaning_wrapper)
 
         # Check if adding this word will exceed max_length or words_limit
-        if len(current_page) + len(word_line) > max_length or current_words_count + 1 > words_limit:
+        if current_page and (current_length + len(word_line) > max_length or len(current_page) + 1 > words_limit):
             # Start a new page if limits are exceeded
-            pages.append(current_page)
-            current_page = ""
-            current_words_count = 0
+            yield current_page
+            current_page = []
+            current_length = 0
 
-        # Add word_line to current_page and increment word count
-        current_page += word_line
-        current_words_count += 1
+        current_page.append((row, word_line))
+        current_length += len(word_line)
 
-        # Handle the last page case
-        if index == len(values) - 1 and current_page:
-            pages.append(current_page)
+    if current_page:
+        yield current_page
 
-    return pages
+
+def _render_page(values, hide_meaning: bool, page_index: int = 0, max_length: int = MAX_MESSAGE_LENGTH - 50,
+                 words_limit: int = WORDS_PER_PAGE) -> str or None:
+    """
+    Renders a single page of word-definition pairs. Pages before it are only split, not rendered, and pages after it
+    aren't processed at all.
+
+    :param values: Iterable of tuples containing word and definition.
+    :param hide_meaning: Boolean indicating whether to hide the meaning with a spoiler format.
+    :param page_index: Index of the page to render.
+    :param max_length: Maximum character length for each page.
+    :param words_limit: Maximum number of words per page.
+    :return: The page as a string or None if there are fewer pages.
+    """
+    page = next(islice(_split_into_pages(values, hide_meaning, max_length, words_limit), page_index, None), None)
+    if page is None:
+        return None
+    return "".join(word_line for _, word_line in page)
 
 
 ####################################################################################################################
@@ -216,7 +260,7 @@ def add_word(update, vocabulary_id=None, word=None, meaning=None):
 
     vocabulary_name = _get_vocabulary_name(vocabulary_id)
 
-    logger.debug(f"Adding user {user} word='{word}' meaning='{meaning}' to vocabulary #{vocabulary_id}")
+    logger.debug("Adding user %s word='%s' meaning='%s' to vocabulary #%s", user, word, meaning, vocabulary_id)
 
     word_id = _add_word(user, vocabulary_id, word, meaning)
     if word_id == 0:
@@ -244,7 +288,7 @@ def delete_word_start(update):
     :return: text to be sent to user and language of cancel button. Should be sent with cancel button
     """
     user = get_user(update)
-    logger.debug(f"User {user} initiated word deletion")
+    logger.debug("User %s initiated word deletion", user)
     parameters = get_user_parameters(user)
     vocabulary_id = parameters.current_vocabulary_id
     lang = parameters.language
@@ -272,7 +316,7 @@ def delete_word_finalize(update, vocabulary_id=None, word=None, meaning=None):
     :return: text, reply_markup to be sent to user
     """
     user = get_user(update)
-    logger.debug(f"User {user} provided a word for deletion")
+    logger.debug("User %s provided a word for deletion", user)
     parameters = get_user_parameters(user)
     lang = parameters.language
 
@@ -333,7 +377,7 @@ def words_change_vocabulary(update):
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.WORDS_VOCABULARY_CHOSEN.value, action="edit")
 def words_vocabulary_chosen(update):
     user = get_user(update)
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     vocabulary_id = callback_data[1]
     _set_current_vocabulary(user, vocabulary_id)
     return construct_word_page(update)
@@ -343,7 +387,7 @@ def words_vocabulary_chosen(update):
 def add_specific_word(update):
     user = get_user(update)
     lang = get_user_parameters(user).language
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     _, vocabulary_id, check_db, *rest = callback_data
 
     if check_db:
@@ -370,7 +414,7 @@ def delete_specific_word(update):
     user = get_user(update)
     parameters = get_user_parameters(user)
     lang = parameters.language
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     word_id = callback_data[1]
     word = _get_word_info(word_id)
 
@@ -398,7 +442,7 @@ def recall(update=None, user=None, vocabulary_id=None, limit=15):
 
     words = _get_old_words(user, vocabulary_id, limit)
     if len(words) > 0:
-        page = _word_list_to_pages(words, hide_meaning)[0]
+        page = _render_page(words, hide_meaning)
     else:
         page = translate(lang, "no_words")
 
@@ -448,7 +492,7 @@ def recall(update=None, user=None, vocabulary_id=None, limit=15):
 @route(trigger="callback_query", query_action=QUERY_ACTIONS.MENU_WORDS.value, action="edit")
 def construct_word_page(update, vocabulary_id=None, page=None):
     user = get_user(update)
-    callback_data = json.loads(update["callback_query"]["data"])
+    callback_data = get_callback_data(update)
     parameters = get_user_parameters(user)
 
     if not vocabulary_id and not page:
@@ -462,12 +506,22 @@ def construct_word_page(update, vocabulary_id=None, page=None):
 
     lang = parameters.language
 
-    vocabulary_name = _get_vocabulary_name(vocabulary_id)
+    vocabulary = _get_vocabulary_info(vocabulary_id)
     hide_meaning = parameters.hide_meaning
-    logger.debug(f"User {user} opened word page #{page} of a vocabulary #{vocabulary_id}")
+    logger.debug("User %s opened word page #%s of a vocabulary #%s", user, page, vocabulary_id)
 
-    if not vocabulary_name:
+    if not vocabulary:
         raise ValueError("Couldn't retrieve current vocabulary name")
+    vocabulary_name = vocabulary.vocabulary_name
+
+    pages = _get_word_page_boundaries(user, vocabulary_id, hide_meaning, vocabulary.version)
+    if pages and (page is None or page >= len(pages)):  # last page by default, or if words were deleted since
+        page = len(pages) - 1
+
+    cache_key = (user, vocabulary_id, page, bool(hide_meaning), lang, vocabulary.version)
+    cached = rendered_word_pages.get(cache_key)
+    if cached is not None:
+        return cached
 
     heading = html_wrapper(
         "==================================\n" +
@@ -492,16 +546,9 @@ def construct_word_page(update, vocabulary_id=None, page=None):
         ]
     ]
 
-    words = _get_user_words(user, vocabulary_id)
-
-    if len(words) == 0:
+    if len(pages) == 0:
         text = heading + translate(lang, "no_words")
     else:
-        pages = _word_list_to_pages(words, hide_meaning)
-
-        if page is None:
-            page = len(pages) - 1
-
         if len(pages) != 1:
             button_placeholder = InlineKeyboardButton(text='.', callback_data=json.dumps([None]))
             if page > 0:
@@ -545,7 +592,11 @@ def construct_word_page(update, vocabulary_id=None, page=None):
                 button = button_placeholder
             page_buttons.append(button)
 
+        words = _get_words_between(user, vocabulary_id, *pages[page])
         footer = f"\n{pad(' ' * 36, str(page + 1), True)}/{len(pages)}"
-        text = heading + pages[page] + footer
+        text = heading + (_render_page(words, hide_meaning) or "") + footer
     keyboard = InlineKeyboardMarkup(inline_keyboard=[page_buttons] + menu_buttons)
+
+    if not db.Database.connection.holds_writer:  # uncommitted changes may still be rolled back, don't cache them
+        rendered_word_pages.set(cache_key, (text, keyboard))
     return text, keyboard
@@ -0,0 +1,221 @@
+import json
+import threading
+import uuid
+from concurrent.futures import wait
+import database as db
+from telepot.exception import BotWasBlockedError
+from .utils import get_timestamp
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+BROADCAST_BATCH_SIZE = 60  # recipients sent to between checkpoints, about 2 seconds of the dispatcher's global rate
+BROADCAST_LEASE = 120  # seconds without a renewal after which a running job is considered interrupted
+BROADCAST_LEASE_RENEWAL = BROADCAST_LEASE / 4  # seconds between lease renewals while a batch is being sent
+BROADCAST_RESUME_INTERVAL = 60  # seconds between checks for interrupted jobs
+
+
+class BroadcastManager:
+    """
+    Runs broadcasts as jobs persisted in broadcast_jobs, each in a background thread. Users are processed in user_id
+    order in batches: a batch is handed to the dispatcher at once, which sends it concurrently within rate limits, and
+    once all of it is delivered, outcomes of its recipients and the job's cursor are saved in one transaction. A job
+    interrupted by a restart is resumed from its last checkpoint by any process, so at most one batch is sent twice.
+    Every runner holds the job's claim token, and the job is only written to while the token is unchanged, so a runner
+    that has been taken over stops instead of counting its batches again.
+    """
+    def __init__(self, deliver_message):
+        """
+        :param deliver_message: Bot.deliver_message, queues a message and returns its future.
+        """
+        self.deliver_message = deliver_message
+        self._threads = {}  # {job_id: thread}
+        self._lock = threading.Lock()
+
+    def start(self, text: str or dict, reply_markup=None, exceptions=None) -> int:
+        """
+        Creates a broadcast job and starts it in the background.
+
+        :param text: Message, or {language: message} to send every user the message in their language.
+        :param reply_markup: Reply markup of the message (optional).
+        :param exceptions: user_ids that don't receive the message (optional).
+        :return: job_id
+        """
+        now = get_timestamp()
+        claim = uuid.uuid4().hex
+        exceptions = json.dumps(list(exceptions or []))
+        # excepted users are never recorded, so they don't count towards the total either
+        total = db.Users.execute_query("""
+        SELECT COUNT(*)
+        FROM users
+        WHERE user_id NOT IN (SELECT value FROM json_each(?));
+        """, (exceptions,))[0][0]
+        _, job_id = db.BroadcastJobs.add({
+            "text": json.dumps(text, ensure_ascii=False),
+            "reply_markup": json.dumps(reply_markup) if reply_markup else None,
+            "exceptions": exceptions,
+            "total": total,
+            "created_at": now,
+            "updated_at": now,
+            "claim": claim,
+        })
+        logger.info(f"Started broadcast #{job_id} to {total} users")
+        self._run_in_background(job_id, claim)
+        return job_id
+
+    def resume_unfinished(self):
+        """
+        Resumes jobs interrupted by a restart: running jobs whose lease hasn't been renewed for BROADCAST_LEASE
+        seconds. A job is claimed by replacing its claim token while its updated_at is unchanged, so only one process
+        resumes it, and its previous runner, if it's still alive, stops at its next write.
+        """
+        now = get_timestamp()
+        for job_id, updated_at in db.BroadcastJobs.execute_query("""
+        SELECT job_id, updated_at
+        FROM broadcast_jobs
+        WHERE status = 'running' AND updated_at <= ?;
+        """, (now - BROADCAST_LEASE,)):
+            claim = uuid.uuid4().hex
+            claimed = db.BroadcastJobs.execute_query("""
+            UPDATE broadcast_jobs
+            SET updated_at = ?, claim = ?
+            WHERE job_id = ? AND updated_at = ?;
+            """, (now, claim, job_id, updated_at)).rowcount > 0
+            if claimed:
+                logger.info(f"Resuming broadcast #{job_id}")
+                self._run_in_background(job_id, claim)
+
+    def run_resumer(self, stop_event: threading.Event, interval=BROADCAST_RESUME_INTERVAL):
+        """Resumes interrupted jobs every `interval` seconds until `stop_event` is set. Meant for a daemon thread."""
+        while True:
+            try:
+                self.resume_unfinished()
+            except Exception as e:
+                logger.error(f"Couldn't resume broadcasts: {e}", exc_info=True)
+            if stop_event.wait(interval):
+                return
+
+    def progress(self, job_id: int) -> dict or None:
+        job = db.BroadcastJobs.get({"job_id": job_id}, include_column_names=True)
+        if not job:
+            return None
+        processed = job.sent + job.blocked + job.failed
+        return {
+            "job_id": job.job_id,
+            "status": job.status,
+            "total": job.total,
+            "processed": processed,
+            "sent": job.sent,
+            "blocked": job.blocked,
+            "failed": job.failed,
+            "progress": min(processed / job.total, 1.0) if job.total else 1.0,
+            "created_at": job.created_at,
+            "updated_at": job.updated_at,
+        }
+
+    def _run_in_background(self, job_id, claim):
+        with self._lock:
+            thread = self._threads.get(job_id)
+            if thread is not None and thread.is_alive():
+                return
+            thread = threading.Thread(target=self._run, args=(job_id, claim), name=f"broadcast-{job_id}", daemon=True)
+            self._threads[job_id] = thread
+        thread.start()
+
+    def _run(self, job_id, claim):
+        try:
+            job = db.BroadcastJobs.get({"job_id": job_id}, include_column_names=True)
+            text = json.loads(job.text)
+            reply_markup = json.loads(job.reply_markup) if job.reply_markup else None
+            exceptions = set(json.loads(job.exceptions))
+            last_user_id = job.last_user_id
+
+            while batch := db.Users.execute_query("""
+            SELECT user_id, language
+            FROM users
+            WHERE user_id > ?
+            ORDER BY user_id
+            LIMIT ?;
+            """, (last_user_id, BROADCAST_BATCH_SIZE)):
+                outcomes = self._send_batch(job_id, claim, batch, text, reply_markup, exceptions)
+                last_user_id = batch[-1][0]
+                if outcomes is None or not self._checkpoint(job_id, claim, last_user_id, outcomes):
+                    logger.warning(f"Broadcast #{job_id} has been claimed by another runner, stopping")
+                    return
+
+            db.BroadcastJobs.set({"job_id": job_id, "claim": claim},
+                                 {"status": "finished", "updated_at": get_timestamp()})
+            logger.info(f"Finished broadcast #{job_id}: {self.progress(job_id)}")
+
+        except Exception as e:
+            logger.critical(f"Broadcast #{job_id} failed: {e}", exc_info=True)
+            db.BroadcastJobs.set({"job_id": job_id, "claim": claim},
+                                 {"status": "failed", "updated_at": get_timestamp()})
+
+    def _send_batch(self, job_id, claim, batch, text, reply_markup, exceptions) -> list[tuple[int, str]] or None:
+        """
+        Queues messages of the whole batch, then waits for them, renewing the job's lease meanwhile, as a single send
+        retried by the network layer can take longer than the lease.
+
+        :return: [(user_id, outcome)], or None if the job has been claimed by another runner and the rest of the batch
+         has been cancelled
+        """
+        futures = []
+        outcomes = []
+        for user, lang in batch:
+            if user in exceptions:
+                continue
+            message = text.get(lang) if isinstance(text, dict) else text
+            if not message:
+                logger.warning(f"Broadcast has no message in language {lang} of user {user}")
+                outcomes.append((user, "failed"))
+                continue
+            futures.append((user, self.deliver_message(user, message, reply_markup=reply_markup)))
+
+        pending = {future for _, future in futures}
+        while pending:
+            _, pending = wait(pending, timeout=BROADCAST_LEASE_RENEWAL)
+            if pending and not self._renew_lease(job_id, claim):
+                for future in pending:
+                    future.cancel()  # messages already being sent can't be cancelled, the new runner sends them again
+                return None
+
+        for user, future in futures:
+            try:
+                future.result()
+                outcomes.append((user, "sent"))
+            except BotWasBlockedError:
+                outcomes.append((user, "blocked"))
+            except Exception:
+                outcomes.append((user, "failed"))  # logged by the dispatcher
+        return outcomes
+
+    @staticmethod
+    def _renew_lease(job_id, claim) -> bool:
+        """:return: False if the job has been claimed by another runner"""
+        return db.BroadcastJobs.execute_query("""
+        UPDATE broadcast_jobs
+        SET updated_at = ?
+        WHERE job_id = ? AND claim = ?;
+        """, (get_timestamp(), job_id, claim)).rowcount > 0
+
+    @staticmethod
+    def _checkpoint(job_id, claim, last_user_id, outcomes) -> bool:
+        """:return: False if the job has been claimed by another runner, then nothing is saved"""
+        counts = {"sent": 0, "blocked": 0, "failed": 0}
+        for _, outcome in outcomes:
+            counts[outcome] += 1
+
+        with db.Database.transaction():
+            owned = db.BroadcastJobs.execute_query("""
+            UPDATE broadcast_jobs
+            SET last_user_id = ?, sent = sent + ?, blocked = blocked + ?, failed = failed + ?, updated_at = ?
+            WHERE job_id = ? AND claim = ?;
+            """, (last_user_id, counts["sent"], counts["blocked"], counts["failed"], get_timestamp(), job_id,
+                  claim)).rowcount > 0
+            if owned and outcomes:
+                db.BroadcastRecipients.add_bulk([{"job_id": job_id, "user_id": user, "status": outcome}
+                                                 for user, outcome in outcomes], replace=True)
+        return owned
@@ -0,0 +1,89 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe cache with least-recently-used eviction and optional time-to-live of entries. Keeps hit/miss counters
+    and an estimate of memory taken by cached values, so it can be sized from its stats.
+    """
+    def __init__(self, max_entries: int, ttl: float = None, sizeof=sys.getsizeof):
+        """
+        :param max_entries: Maximum number of entries, the least recently used one is evicted when it's exceeded.
+        :param ttl: Seconds after which an entry expires (optional, entries don't expire by default).
+        :param sizeof: Function estimating memory size of a cached value in bytes.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # {key: (value, expires_at, size)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_size = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.memory_size -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+                self._remove(key)  # expired
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self.memory_size += size
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_where(self, predicate):
+        """Removes all entries whose key satisfies `predicate`. Checks every entry, so it's meant for rare events."""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "memory_size": self.memory_size,
+        }
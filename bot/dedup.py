@@ -0,0 +1,73 @@
+import threading
+import time
+from collections import OrderedDict
+import database as db
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+DEDUP_WINDOW = 60 * 60  # seconds an update_id is remembered, Telegram redelivers unanswered updates within it
+MAX_SEEN_UPDATES = 100_000
+DEDUP_PRUNE_EVERY = 1000  # persisted update_ids older than the window are deleted once per this many updates
+
+
+class UpdateDeduplicator:
+    """
+    Remembers update_ids seen within the last `window` seconds, so updates Telegram delivers again after a slow or
+    failed answer are dropped instead of being processed twice. Kept in memory, and optionally in seen_updates table
+    to recognize redeliveries across restarts. Persisting costs a write and a commit per update, even a read-only one,
+    so it's off by default: the webhook answers before processing, so redeliveries mostly follow refused updates,
+    which are never marked as seen.
+    """
+    def __init__(self, window: int = DEDUP_WINDOW, max_entries: int = MAX_SEEN_UPDATES, persist: bool = False):
+        self.window = window
+        self.max_entries = max_entries
+        self.persist = persist
+        self._seen = OrderedDict()  # {update_id: seen_at}, oldest first
+        self._lock = threading.Lock()
+        self._since_prune = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, update: dict) -> bool:
+        """Marks the update as seen. Returns True if it has already been seen within the window."""
+        update_id = update.get("update_id")
+        if update_id is None:
+            return False
+
+        now = time.time()
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) <= now - self.window:
+                self._seen.popitem(last=False)
+
+            duplicate = update_id in self._seen
+            if not duplicate:
+                self._seen[update_id] = now
+                if len(self._seen) > self.max_entries:
+                    self._seen.popitem(last=False)
+
+        if not duplicate and self.persist:
+            duplicate = not db.SeenUpdates.mark_seen(update_id, int(now))
+            self._prune(int(now))
+
+        if duplicate:
+            with self._lock:
+                self.duplicates += 1
+            logger.info(f"Dropped duplicate update {update_id}")
+        return duplicate
+
+    def _prune(self, now):
+        with self._lock:
+            self._since_prune += 1
+            if self._since_prune < DEDUP_PRUNE_EVERY:
+                return
+            self._since_prune = 0
+        db.SeenUpdates.delete_older_than(now - self.window)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "remembered": len(self._seen),
+                "duplicates": self.duplicates,
+            }
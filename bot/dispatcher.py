@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from telepot.exception import TooManyRequestsError
+from .cache import LRUCache
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+GLOBAL_RATE = 30  # messages per second to all chats, Telegram's limit for bots
+PER_CHAT_RATE = 1  # messages per second to a single chat
+PER_CHAT_BURST = 3  # messages a chat can get at once after being idle, e.g. an answer followed by a setup prompt
+DISPATCHER_WORKERS = 4
+MAX_RATE_LIMIT_RETRIES = 3
+MAX_CHAT_BUCKETS = 10_000
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second, holding at most `capacity` tokens."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_consume(self) -> float:
+        """
+        Takes a token if there is one.
+
+        :return: 0 if a token was taken, otherwise seconds until the next one is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """Takes a token, waiting for it if necessary."""
+        while (wait := self.try_consume()) > 0:
+            time.sleep(wait)
+
+
+class MessageDispatcher:
+    """
+    Sends outbound Telegram requests from worker threads, so callers only enqueue them. Requests pass a global token
+    bucket and a bucket of their chat, and requests to the same chat are sent one at a time in the order they were
+    submitted, so an edit never overtakes the message it edits. A chat waiting for its bucket doesn't hold a worker.
+    """
+    def __init__(self, workers: int = DISPATCHER_WORKERS, global_rate: float = GLOBAL_RATE,
+                 per_chat_rate: float = PER_CHAT_RATE, per_chat_burst: float = PER_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, 1)  # no bursts, any one-second window stays within the rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        # an idle bucket is full again after ttl, then it's no different from a new one and can be dropped
+        self._chat_buckets = LRUCache(MAX_CHAT_BUCKETS, ttl=per_chat_burst / per_chat_rate)
+
+        self._pending = {}  # {chat_id: deque of (future, function, args, kwargs)}, chats with queued requests
+        self._ready = []  # heap of (ready_at, seq, chat_id), pending chats not being sent to right now
+        self._seq = itertools.count()  # keeps heap order stable for chats ready at the same time
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+        self._workers = [threading.Thread(target=self._work, name=f"dispatcher-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        self._chat_buckets.set(chat_id, bucket)  # refreshes ttl
+        return bucket
+
+    def submit(self, chat_id, function, *args, **kwargs) -> Future:
+        """
+        Queues `function(*args, **kwargs)`, a Telegram request to `chat_id`.
+
+        :return: Future of the request's result, e.g. the sent message
+        """
+        future = Future()
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError("Dispatcher is stopped")
+            if chat_id not in self._pending:
+                self._pending[chat_id] = deque()
+                heapq.heappush(self._ready, (time.monotonic(), next(self._seq), chat_id))
+                self._condition.notify()
+            self._pending[chat_id].append((future, function, args, kwargs))
+            self.queued += 1
+        return future
+
+    def _next_chat(self):
+        """Waits for a chat whose bucket has a token. Returns None when stopping and nothing is left to send."""
+        with self._condition:
+            while True:
+                if self._ready:
+                    ready_at, _, chat_id = self._ready[0]
+                    wait = ready_at - time.monotonic()
+                    if wait <= 0:
+                        heapq.heappop(self._ready)
+                        wait = self._chat_bucket(chat_id).try_consume()
+                        if wait <= 0:
+                            return chat_id
+                        heapq.heappush(self._ready, (time.monotonic() + wait, next(self._seq), chat_id))
+                        continue
+                elif self._stopping:
+                    return None
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+    def _work(self):
+        while (chat_id := self._next_chat()) is not None:
+            with self._condition:
+                future, function, args, kwargs = self._pending[chat_id].popleft()
+                self.queued -= 1
+
+            outcome = None
+            if future.set_running_or_notify_cancel():
+                outcome = self._send(future, function, args, kwargs)
+
+            with self._condition:
+                if outcome == "sent":
+                    self.sent += 1
+                elif outcome == "failed":
+                    self.failed += 1
+
+                if self._pending[chat_id]:
+                    heapq.heappush(self._ready, (time.monotonic(), next(self._seq), chat_id))
+                    self._condition.notify()
+                else:
+                    del self._pending[chat_id]
+
+    def _send(self, future, function, args, kwargs) -> str:
+        """Sends the request, retrying when Telegram asks to slow down, and resolves its future with the outcome."""
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            self.global_bucket.consume()
+            try:
+                result = function(*args, **kwargs)
+            except TooManyRequestsError as e:
+                with self._condition:
+                    self.rate_limited += 1
+                if attempt == MAX_RATE_LIMIT_RETRIES:
+                    future.set_exception(e)
+                    return "failed"
+                retry_after = (e.json or {}).get("parameters", {}).get("retry_after", 1)
+                logger.warning(f"Rate limited by Telegram, retrying in {retry_after}s")
+                time.sleep(retry_after)
+            except Exception as e:
+                logger.error(f"Couldn't send {function.__name__} with args {args}: {e}")
+                future.set_exception(e)
+                return "failed"
+            else:
+                future.set_result(result)
+                return "sent"
+
+    def close(self, timeout: float = None):
+        """Stops accepting requests and waits up to `timeout` seconds for queued ones to be sent."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "queued": self.queued,
+                "chats_pending": len(self._pending),
+                "sent": self.sent,
+                "failed": self.failed,
+                "rate_limited": self.rate_limited,
+            }
@@ -1,32 +1,117 @@
+import json
+import threading
+import time
 import database as db
 from . import TEMP_KEYS
 from ._enums import TaskStatus, QUERY_ACTIONS, TEMP_KEYS, USER_STATES
+from .cache import LRUCache
 from logger import setup_logger
 
 
 logger = setup_logger(__name__)
 
 
-user_parameters = {}
-
-
-def set_temp(user, key, value):
-    if db.Temp.add({"user_id": user, "key": key, "value": value}):
-        logger.debug(f"Temp set for user {user} key={key} value={value}")
+USER_PARAMETERS_CACHE_SIZE = 10_000
+USER_PARAMETERS_TTL = 600  # seconds, bounds staleness if a write to users misses invalidate_cached_parameters
+
+# {user_id: users row}. Every code path writing users rows, directly or through vocabulary triggers, must call
+# invalidate_cached_parameters afterward
+user_parameters = LRUCache(USER_PARAMETERS_CACHE_SIZE, ttl=USER_PARAMETERS_TTL)
+
+TEMP_CACHE_SIZE = 10_000  # users whose temp values are kept in memory
+TEMP_TTL = 24 * 60 * 60  # seconds, entries of abandoned flows are treated as absent afterward
+TEMP_SWEEP_INTERVAL = 10 * 60  # seconds between sweeps of expired temp rows
+TEMP_SWEEP_CHUNK_SIZE = 500  # rows deleted per write, keeps the write lock free for updates in between
+
+
+class TempStore:
+    """
+    Temp values kept in memory and written through to the temp table, which only serves to restore them after a
+    restart. Temp rows of a user are loaded all at once on their first access, so later reads of any key, present or
+    not, don't touch the database and removing an absent key costs nothing. Values written by another process are
+    never seen, so the bot runs in a single process, which flask_app enforces.
+    """
+    def __init__(self, max_users: int):
+        self._users = LRUCache(max_users)  # {user_id: {key: (value, expires_at)}}
+
+    @staticmethod
+    def _as_stored(value):
+        """Converts value the way the TEXT column of temp table does, so it reads the same from memory and database."""
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            value = int(value)
+        return str(value)
+
+    @staticmethod
+    def _key(key) -> str:
+        """Keys are TEXT in temp table, so TEMP_KEYS values are kept as strings too, or reloaded rows wouldn't match."""
+        return str(key)
+
+    def _load(self, user) -> dict:
+        values = self._users.get(user)
+        if values is None:
+            rows = db.Temp.get({"user_id": user}, custom_select="SELECT key, value, expires_at FROM temp",
+                               force_2d=True)
+            values = {key: (value, expires_at) for key, value, expires_at in rows}
+            self._users.set(user, values)
+        return values
+
+    def get(self, user, key):
+        value, expires_at = self._load(user).get(self._key(key), (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            return None  # the row is left for the sweeper
+        return value
+
+    def set(self, user, key, value, ttl: int = None) -> bool:
+        key = self._key(key)
+        values = self._load(user)
+        expires_at = int(time.time()) + ttl if ttl is not None else None
+        if not db.Temp.add({"user_id": user, "key": key, "value": value, "expires_at": expires_at})[0]:
+            return False
+        values[key] = (self._as_stored(value), expires_at)
+        return True
+
+    def remove(self, user, key) -> bool:
+        key = self._key(key)
+        values = self._load(user)
+        if key not in values:
+            return False
+        del values[key]
+        return bool(db.Temp.delete({"user_id": user, "key": key}))
+
+    def invalidate(self, user):
+        self._users.invalidate(user)
+
+    def stats(self):
+        return self._users.stats()
+
+
+# Temp values must only be accessed through this store, writing temp table directly leaves it stale
+temp_store = TempStore(TEMP_CACHE_SIZE)
+
+
+def invalidate_cached_temp(user):
+    temp_store.invalidate(user)
+
+
+def set_temp(user, key, value, ttl=TEMP_TTL):
+    """
+    :param ttl: Seconds after which the value is treated as absent, None for values that must never expire.
+    """
+    if temp_store.set(user, key, value, ttl):
+        logger.debug("Temp set for user %s key=%s value=%s", user, key, value)
         return TaskStatus.SUCCESS
     return TaskStatus.FAILURE
 
 
 def get_temp(user, key):
-    entry = db.Temp.get({"user_id": user, "key": key}, include_column_names=True)
-    if entry:
-        return entry.value
-    return None
+    return temp_store.get(user, key)
 
 
 def remove_temp(user, key):
-    if db.Temp.delete({"user_id": user, "key": key}):
-        logger.debug(f"Temp removed for user {user} key={key}")
+    if temp_store.remove(user, key):
+        logger.debug("Temp removed for user %s key=%s", user, key)
         return TaskStatus.SUCCESS
     return TaskStatus.FAILURE
 
@@ -37,7 +122,40 @@ def pop_temp(user, key):
     return value
 
 
+def sweep_expired_temp(chunk_size=TEMP_SWEEP_CHUNK_SIZE, pause=0.05):
+    """
+    Deletes expired temp rows in chunks, each in its own short write, pausing in between so updates waiting for the
+    write lock aren't delayed by the sweep. Expired values still held in memory are already treated as absent.
+
+    :return: Number of deleted rows
+    """
+    now = int(time.time())
+    deleted = 0
+    while True:
+        count = db.Temp.delete_expired(now, chunk_size)
+        deleted += count
+        if count < chunk_size:
+            break
+        time.sleep(pause)
+
+    if deleted:
+        logger.info(f"Swept {deleted} expired temp entries")
+    return deleted
+
+
+def run_temp_sweeper(stop_event: threading.Event, interval=TEMP_SWEEP_INTERVAL):
+    """Sweeps expired temp rows every `interval` seconds until `stop_event` is set. Meant for a daemon thread."""
+    while not stop_event.wait(interval):
+        try:
+            sweep_expired_temp()
+        except Exception as e:
+            logger.error(f"Couldn't sweep expired temp entries: {e}", exc_info=True)
+
+
 def get_user(update):
+    if isinstance(update, UpdateContext):
+        return update.user
+
     if "message" in update:
         user = update["message"]["chat"]["id"]
     elif "callback_query" in update:
@@ -50,11 +168,69 @@ def get_user(update):
     return user
 
 
+class UpdateContext(dict):
+    """
+    Update together with what is derived from it, parsed once by Bot.handle_update and passed to routes in place of
+    the raw update. It is the update dict itself, so handlers reading raw fields keep working.
+
+    Parameters aren't snapshotted: handlers change them mid-update, and reading through get_user_parameters keeps the
+    context consistent with invalidate_cached_parameters.
+    """
+    def __init__(self, update: dict):
+        super().__init__(update)
+        self.user = get_user(update)
+        self.trigger = None
+        self.command = None
+        self.callback_data = None
+        self.query_action = None
+        self.msg_id = None
+        self.callback_query_id = None
+        self.state = None  # set by Bot.handle_update, only plain text messages are routed by state
+        self.missing_setup = None  # set by Bot.handle_update before routing
+
+        if "message" in update:
+            if "text" in update["message"]:
+                self.trigger = "text"
+                text = update["message"]["text"]
+                if text.startswith("/"):
+                    command = text.split()[0].lower()
+                    self.command = command if command in {"/start", "/menu", "/help"} else "default"
+            else:
+                self.trigger = "other"
+
+        elif "callback_query" in update:
+            self.trigger = "callback_query"
+            self.callback_data = json.loads(update["callback_query"]["data"])
+            self.query_action = self.callback_data[0]
+            self.msg_id = update["callback_query"]["message"]["message_id"]
+            self.callback_query_id = update["callback_query"]["id"]
+
+        elif "my_chat_member" in update:
+            self.trigger = "chat_member"
+
+    @property
+    def parameters(self):
+        return get_user_parameters(self.user)
+
+
+def get_callback_data(update) -> list:
+    if isinstance(update, UpdateContext):
+        return update.callback_data
+    return json.loads(update["callback_query"]["data"])
+
+
 def check_missing_setup(user):
+    """
+    Returns the first setup stage the user hasn't finished, or None. Once everything is set up, the user is marked
+    with setup_complete, so later updates of onboarded users are answered from their cached parameters alone.
+    """
     parameters = get_user_parameters(user)
     if not parameters:
         return "user"
 
+    if parameters.setup_complete:
+        return None
+
     lang = parameters.language
     if not lang:
         return "lang"
@@ -67,39 +243,42 @@ def check_missing_setup(user):
     if timezone_not_set:
         return "timezone"
 
+    if db.Users.set({"user_id": user}, {"setup_complete": 1}):
+        invalidate_cached_parameters(user)
+        logger.info(f"User {user} has completed setup")
     return None
 
 
 def get_user_parameters(user):
-    if user in user_parameters:
-        return user_parameters[user]
+    parameters = user_parameters.get(user)
+    if parameters is not None:
+        return parameters
 
     parameters = db.Users.get({"user_id": user}, include_column_names=True)
     if len(parameters) > 0:
-        user_parameters[user] = parameters
+        user_parameters.set(user, parameters)
     return parameters
 
 
 def invalidate_cached_parameters(user):
-    if user in user_parameters:
-        del user_parameters[user]
+    user_parameters.invalidate(user)
 
 
 def get_user_state(user):
     state = get_temp(user, TEMP_KEYS.STATE.value)
-    logger.debug(f"User state: {state}")
+    logger.debug("User state: %s", state)
     return int(state) if state is not None else None
 
 
 def set_user_state(user, state):
     status = set_temp(user, TEMP_KEYS.STATE.value, state)
     if status:
-        logger.debug(f"User state was set to: {state}")
+        logger.debug("User state was set to: %s", state)
     return status
 
 
 def reset_user_state(user):
     status = remove_temp(user, TEMP_KEYS.STATE.value)
     if status:
-        logger.debug(f"User state was reset")
+        logger.debug("User state was reset")
     return status
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import deque
+from .temp_manager import get_user
+from logger import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+UPDATE_WORKERS = 8
+MAX_QUEUED_UPDATES = 1000  # beyond this, updates are refused and Telegram redelivers them later
+_STOPPED = object()  # returned to workers instead of a user once the pool is stopped and drained
+
+
+class UpdateWorkerPool:
+    """
+    Processes updates in worker threads, so the webhook only has to queue them. Updates of different users are
+    processed concurrently, while updates of the same user are processed one at a time in update_id order, as each of
+    them may depend on the state left by the previous one. Concurrent webhook deliveries can hand a user's updates
+    over out of order, so queued ones are kept sorted; an update that arrives after a later one has already been
+    taken by a worker is processed next.
+    """
+    def __init__(self, handle_update, workers: int = UPDATE_WORKERS, max_queued: int = MAX_QUEUED_UPDATES):
+        """
+        :param handle_update: Bot.handle_update
+        :param workers: Number of worker threads.
+        :param max_queued: Maximum number of queued updates, submit() refuses updates beyond it.
+        """
+        self.handle_update = handle_update
+        self.max_queued = max_queued
+
+        self._pending = {}  # {user_id: deque of (update, queued_at)}, users with queued updates
+        self._ready = deque()  # pending users no worker is processing right now, in order they became ready
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        self.queued = 0
+        self.processing = 0
+        self.processed = 0
+        self.refused = 0
+        self.total_lag = 0.0  # seconds updates spent queued, summed over processed updates
+        self.max_lag = 0.0
+
+        self._workers = [threading.Thread(target=self._work, name=f"update-worker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    @staticmethod
+    def _key(update):
+        try:
+            return get_user(update)
+        except KeyError:
+            return None  # handle_update reports updates without user, they are just processed in order too
+
+    def submit(self, update: dict) -> bool:
+        """
+        Queues the update for processing.
+
+        :return: False if the queue is full or the pool is stopped and the update wasn't queued
+        """
+        user = self._key(update)
+        with self._condition:
+            if self._stopping or self.queued >= self.max_queued:
+                self.refused += 1
+                return False
+            if user not in self._pending:
+                self._pending[user] = deque()
+                self._ready.append(user)
+                self._condition.notify()
+            updates = self._pending[user]
+            index = len(updates)
+            update_id = update.get("update_id")
+            if update_id is not None:  # usually already the last, so the search stops at once
+                while index > 0 and updates[index - 1][0].get("update_id", update_id) > update_id:
+                    index -= 1
+            updates.insert(index, (update, time.monotonic()))
+            self.queued += 1
+        return True
+
+    def _next_user(self):
+        """Waits for a user with queued updates. Returns _STOPPED when stopping and nothing is left to process."""
+        with self._condition:
+            while not self._ready:
+                if self._stopping:
+                    return _STOPPED
+                self._condition.wait()
+            return self._ready.popleft()
+
+    def _work(self):
+        while (user := self._next_user()) is not _STOPPED:
+            with self._condition:
+                update, queued_at = self._pending[user].popleft()
+                self.queued -= 1
+                self.processing += 1
+            lag = time.monotonic() - queued_at
+
+            try:
+                self.handle_update(update)
+            except Exception as e:  # handle_update reports its own errors, this only keeps the worker alive
+                logger.critical(f"Unhandled error while processing update: {e}", exc_info=True)
+
+            with self._condition:
+                self.processing -= 1
+                self.processed += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+                if self._pending[user]:
+                    self._ready.append(user)  # to the back, so a busy user doesn't hold the worker from others
+                    self._condition.notify()
+                else:
+                    del self._pending[user]
+
+    def close(self, timeout: float = None):
+        """Stops accepting updates and waits up to `timeout` seconds for queued ones to be processed."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def stats(self):
+        with self._condition:
+            now = time.monotonic()
+            oldest = min((queued_at for updates in self._pending.values() for _, queued_at in updates), default=None)
+            return {
+                "queued": self.queued,
+                "users_pending": len(self._pending),
+                "processing": self.processing,
+                "processed": self.processed,
+                "refused": self.refused,
+                "current_lag": now - oldest if oldest is not None else 0.0,
+                "average_lag": self.total_lag / self.processed if self.processed else 0.0,
+                "max_lag": self.max_lag,
+            }
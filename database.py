@@ -1,29 +1,161 @@
 import sqlite3
 import os
+import threading
 import time
 from collections import namedtuple
+from contextlib import contextmanager
 
 from logger import setup_logger
 
 MAX_RETRIES = 3
 INITIAL_DELAY = 0.5
+BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 5))  # seconds SQLite waits on a locked database before failing
+ITER_BATCH_SIZE = 500  # rows fetched at once by Database.iter_query
 
 logger = setup_logger(__name__)
 
 
-class Connection:
+class ConnectionPool:
+    """
+    Manages SQLite connections shared by all table classes. Every thread gets its own reader connection, while all
+    writes go through a single writer connection guarded by a lock. The database runs in WAL mode, so readers don't
+    block the writer and vice versa.
+    """
     def __init__(self, database_name, timeout):
-        db_path = os.path.expanduser(f"~/mysite/{database_name}")
-        logger.info(f"Connecting to database at {db_path}...")
-        self.connection = sqlite3.connect(db_path, timeout=timeout)
-        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.db_path = os.path.expanduser(f"~/mysite/{database_name}")
+        self.timeout = timeout
+        self.write_lock = threading.RLock()
+        self._readers = {}  # {thread: connection}
+        self._readers_lock = threading.Lock()
+        self._local = threading.local()  # transaction state of the current thread
+
+        logger.info(f"Connecting to database at {self.db_path}...")
+        self.writer = self._connect()
+        journal_mode = self.writer.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        logger.info(f"Database journal mode: {journal_mode}")
 
     def __del__(self):
+        self.close()
+
+    def _connect(self, read_only=False):
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        connection.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+        connection.execute('PRAGMA foreign_keys=ON')
+        if read_only:
+            connection.execute('PRAGMA query_only=ON')
+        return connection
+
+    @property
+    def reader(self):
+        """Reader connection of the current thread. Connections of finished threads are closed on the way."""
+        thread = threading.current_thread()
+        connection = self._readers.get(thread)
+        if connection is not None:
+            return connection
+
+        connection = self._connect(read_only=True)
+        with self._readers_lock:
+            for dead_thread in [t for t in self._readers if not t.is_alive()]:
+                self._readers.pop(dead_thread).close()
+            self._readers[thread] = connection
+        logger.debug("Opened reader connection for thread %s", thread.name)
+        return connection
+
+    @property
+    def in_transaction(self):
+        return getattr(self._local, "depth", 0) > 0
+
+    @property
+    def holds_writer(self):
+        """Whether the transaction of the current thread has written and owns the writer until it ends."""
+        return getattr(self._local, "holds_writer", False)
+
+    @property
+    def query_count(self):
+        """Number of queries executed by the current thread since the last reset_query_count()."""
+        return getattr(self._local, "query_count", 0)
+
+    def count_query(self):
+        self._local.query_count = self.query_count + 1
+
+    def reset_query_count(self):
+        self._local.query_count = 0
+
+    def begin(self):
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+
+    def acquire_writer(self):
+        """
+        Takes the writer for the rest of the current transaction. The lock is only taken on the first write, so
+        transactions that only read never block other threads.
+        """
+        if not self.holds_writer:
+            self.write_lock.acquire()
+            self._local.holds_writer = True
+        return self.writer
+
+    def end(self, commit=True):
+        self._local.depth -= 1
+        if self._local.depth > 0 or not self.holds_writer:
+            return  # nested block or nothing has been written
+
+        try:
+            if commit:
+                self.writer.commit()
+            else:
+                self.writer.rollback()
+                logger.warning("Transaction rolled back")
+        finally:
+            self._local.holds_writer = False
+            self.write_lock.release()
+
+    def close(self):
         logger.info("Disconnecting from database...")
-        self.connection.close()
+        with self._readers_lock:
+            while self._readers:
+                self._readers.popitem()[1].close()
+        with self.write_lock:
+            self.writer.close()
+
+
+Statement = namedtuple('Statement', ['query', 'columns'])
+
 
-    def __getattr__(self, name):
-        return getattr(self.connection, name)
+class StatementCache:
+    """
+    Keeps SQL built by the CRUD helpers of Database together with the validated columns it binds, keyed by
+    (table, operation, columns, flags). The bot only uses a small fixed set of query shapes, so after warm-up building
+    a query is a dict lookup.
+    """
+    def __init__(self):
+        self.statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        statement = self.statements.get(key)
+        if statement is not None:
+            self.hits += 1
+            return statement
+
+        self.misses += 1
+        statement = build()  # validates columns, so invalid shapes raise and are never cached
+        self.statements[key] = statement
+        return statement
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.statements),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        self.statements.clear()
+        self.hits = 0
+        self.misses = 0
 
 
 class CursorError:
@@ -64,14 +196,71 @@ class Database:
     table_name = ""
     create_table_query = ""
     columns = ()
+    migrations = ()  # ordered steps, each a tuple of queries; schema version of the table is number of applied steps
+
+    connection = ConnectionPool('data.db', timeout=BUSY_TIMEOUT)
+    statement_cache = StatementCache()
+    row_types = {}  # {(table_name, custom_select): namedtuple class}, shared by all tables
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """
+        Runs all queries of the block as one transaction: committed once at the end, rolled back if the block raises.
+        Nested blocks join the outer transaction.
+        """
+        cls.connection.begin()
+        try:
+            yield
+        except BaseException:
+            cls.connection.end(commit=False)
+            raise
+        cls.connection.end(commit=True)
+
+    @classmethod
+    def execute_query(cls, query: str, params: list or tuple = (), multiple: bool = False):
+        """
+        Executes a given SQLite query with optional parameters. Returns number of affected rows or fetched data.
+        SELECT queries run on the reader connection of the current thread, everything else is serialized through the
+        writer connection. Inside Database.transaction() nothing is committed until the block ends, and once the
+        transaction has written, its reads go through the writer as well to see its own changes.
+        """
+        logger.debug("Executing query: %s", (query, params))
+        is_select = query.strip().upper().startswith("SELECT")
+        pool = cls.connection
+        pool.count_query()
+        if is_select and not pool.holds_writer:
+            return cls._execute(pool.reader, query, params, multiple, is_select, autocommit=False)
+
+        if pool.in_transaction:
+            return cls._execute(pool.acquire_writer(), query, params, multiple, is_select, autocommit=False)
+
+        with pool.write_lock:
+            return cls._execute(pool.writer, query, params, multiple, is_select, autocommit=True)
 
-    connection = Connection('data.db', timeout=5)
+    @classmethod
+    def iter_query(cls, query: str, params: list or tuple = (), batch_size: int = ITER_BATCH_SIZE):
+        """
+        Executes a SELECT query and yields its rows, fetching them in batches. Unlike execute_query, the result is
+        never materialized as a whole or written to logs, which makes it suitable for whole-table scans.
+        """
+        logger.debug("Iterating query: %s", (query, params))
+        pool = cls.connection
+        pool.count_query()
+        connection = pool.writer if pool.holds_writer else pool.reader
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query, tuple(params))
+            row_count = 0
+            while rows := cursor.fetchmany(batch_size):
+                row_count += len(rows)
+                yield from rows
+            logger.debug("Query iterated successfully. Rows: %s", row_count)
+        finally:
+            cursor.close()
 
     @classmethod
-    def execute_query(cls, query: str, params: list or tuple = (), multiple: bool = False, retrying: bool = False):
-        """Executes a given SQLite query with optional parameters. Returns number of affected rows or fetched data"""
-        logger.debug(f"Executing query: {query, params}")
-        connection = cls.connection
+    def _execute(cls, connection, query, params, multiple, is_select, autocommit):
         cursor = connection.cursor()
 
         retry = False
@@ -90,13 +279,14 @@ class Database:
                     logger.debug("Executing with no parameters")
                     cursor.execute(query)
 
-                if not query.strip().upper().startswith("SELECT"):
-                    connection.commit()
-                    logger.debug(f"Query executed successfully")
+                if not is_select:
+                    if autocommit:
+                        connection.commit()
+                    logger.debug("Query executed successfully")
                     return cursor
                 else:
                     results = cursor.fetchall()  # Return results for SELECT statements
-                    logger.debug(f"Query executed successfully. Results: {results}")
+                    logger.debug("Query executed successfully. Results: %s", results)
                     return results
 
             # handle errors
@@ -110,24 +300,14 @@ class Database:
                     retry = True
                     continue
 
-                elif "no such table" in error_message and not retrying:
-                    logger.warning(f"Table not found: {cls.table_name}. Attempting to create the table...")
-                    try:
-                        cls.create_table()  # Attempt to create the table
-                        logger.info("Table created successfully. Retrying the original query...")
-                    except sqlite3.Error as create_e:
-                        logger.critical(f"Failed to create table: {create_e}", exc_info=True)
-                        raise create_e
-
-                    # Retry the original query after creating the table
-                    return cls.execute_query(query, params, multiple, retrying=True)
-
                 else:
                     logger.exception(f"OperationalError: {error_message}")
                     raise e
 
             except sqlite3.IntegrityError as e:
                 logger.warning(f"IntegrityError: {str(e)}")
+                if autocommit:
+                    connection.rollback()  # don't leave the shared writer inside a failed transaction
                 return CursorError("IntegrityError")  # Handle duplicate entries and other integrity issues
 
             except sqlite3.DatabaseError as e:
@@ -150,9 +330,49 @@ class Database:
             raise ValueError(f"Invalid column(s): {', '.join(invalid_columns)}")
 
     @classmethod
-    def create_table(cls) -> None:
-        """Create the table specified by class, and create indexes if defined."""
-        cls.execute_query(cls.create_table_query)
+    def get_schema_version(cls) -> int:
+        result = cls.execute_query("SELECT version FROM schema_version WHERE table_name = ?", (cls.table_name,))
+        return result[0][0] if result else 0
+
+    @classmethod
+    def migrate(cls) -> None:
+        """
+        Applies migration steps of the table that haven't been applied yet. Each step runs in its own transaction
+        together with the schema_version update, so a failed step leaves the table at the previous version. The
+        transaction takes the database write lock before reading the version, so when several processes start at
+        once, each step is applied by exactly one of them and the others see it as done.
+        """
+        pool = cls.connection
+        with pool.write_lock:
+            while True:
+                version = None
+                try:
+                    pool.writer.execute("BEGIN IMMEDIATE")
+                    result = pool.writer.execute("SELECT version FROM schema_version WHERE table_name = ?",
+                                                 (cls.table_name,)).fetchone()
+                    version = (result[0] if result else 0) + 1
+                    if version > len(cls.migrations):
+                        pool.writer.rollback()  # up to date, nothing to apply
+                        return
+
+                    logger.info(f"Migrating table {cls.table_name} to version {version}...")
+                    for query in cls.migrations[version - 1]:
+                        pool.writer.execute(query)
+                    pool.writer.execute("INSERT OR REPLACE INTO schema_version (table_name, version) VALUES (?, ?)",
+                                        (cls.table_name, version))
+                    pool.writer.commit()
+                except sqlite3.Error as e:
+                    pool.writer.rollback()
+                    logger.critical(f"Failed to migrate table {cls.table_name} to version {version}: {e}",
+                                    exc_info=True)
+                    raise e
+
+    @classmethod
+    def _build_insert(cls, columns: tuple, replace: bool) -> Statement:
+        cls.validate_columns(columns)
+        placeholders = ', '.join('?' * len(columns))
+        verb = "INSERT OR REPLACE" if replace else "INSERT"
+        return Statement(f"{verb} INTO {cls.table_name} ({', '.join(columns)}) VALUES ({placeholders})", columns)
 
     @classmethod
     def add(cls, data: dict, replace: bool = False) -> tuple[bool, int]:
@@ -167,17 +387,9 @@ class Database:
         """
         if not data:
             raise ValueError("No data provided for insertion.")
-        cls.validate_columns(data)
-
-        columns = ', '.join(data.keys())
-        placeholders = ', '.join('?' * len(data))
-
-        if replace:
-            query = f"INSERT OR REPLACE INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-        else:
-            query = f"INSERT INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-
-        cursor = cls.execute_query(query, data.values())
+        statement = cls.statement_cache.get((cls.table_name, "add", tuple(data), replace),
+                                            lambda: cls._build_insert(tuple(data), replace))
+        cursor = cls.execute_query(statement.query, data.values())
 
         return cursor.rowcount > 0, cursor.lastrowid
 
@@ -215,6 +427,50 @@ class Database:
 
         return cursor.rowcount > 0
 
+    @classmethod
+    def _build_select(cls, columns: tuple, custom_select: str, order_by: str, sort_direction: str, limit: bool,
+                      offset: bool) -> Statement:
+        query = custom_select if custom_select else f"SELECT * FROM {cls.table_name}"
+
+        # Add WHERE conditions if provided
+        if columns:
+            cls.validate_columns(columns)
+            query += f" WHERE {' AND '.join(f'{key} = ?' for key in columns)}"
+
+        # Add ORDER BY if provided
+        if order_by:
+            if order_by not in cls.columns:
+                raise ValueError(f"Invalid column for ordering: {order_by}")
+            if sort_direction.upper() not in ['ASC', 'DESC']:
+                raise ValueError("Sort direction must be either 'ASC' or 'DESC'")
+            query += f" ORDER BY {order_by} {sort_direction.upper()}"
+
+        # Add LIMIT and OFFSET if provided
+        if limit:
+            query += " LIMIT ?"
+
+        if offset:
+            query += " OFFSET ?"
+
+        return Statement(query, columns)
+
+    @classmethod
+    def _row_type(cls, custom_select: str = None):
+        """Returns the row class for the table or for a custom select, creating it only on the first call."""
+        key = (cls.table_name, custom_select)
+        Row = cls.row_types.get(key)
+        if Row is None:
+            if not custom_select:
+                Row = namedtuple('Row', cls.columns)
+            else:
+                columns_part = custom_select.split('FROM')[0].replace('SELECT', '').strip()
+                # Split by commas and trim spaces
+                column_names = [col.strip() for col in columns_part.split(',')]
+                # Map each row's values to the corresponding column name
+                Row = namedtuple('Row', column_names)
+            cls.row_types[key] = Row
+        return Row
+
     @classmethod
     def get(cls, conditions: dict = None, limit: int = None, offset: int = None,
             order_by: str = None, sort_direction: str = 'ASC', include_column_names=False, custom_select=None,
@@ -234,32 +490,16 @@ class Database:
         :return: List of fetched records
         """
 
-        query = custom_select if custom_select else f"SELECT * FROM {cls.table_name}"
-        params = []
-
-        # Add WHERE conditions if provided
-        if conditions:
-            cls.validate_columns(conditions)
-
-            where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
-            query += f" WHERE {where_clause}"
-            params.extend(conditions.values())
-
-        # Add ORDER BY if provided
-        if order_by:
-            if order_by not in cls.columns:
-                raise ValueError(f"Invalid column for ordering: {order_by}")
-            if sort_direction.upper() not in ['ASC', 'DESC']:
-                raise ValueError("Sort direction must be either 'ASC' or 'DESC'")
-            query += f" ORDER BY {order_by} {sort_direction.upper()}"
+        columns = tuple(conditions) if conditions else ()
+        key = (cls.table_name, "get", columns, custom_select, order_by, sort_direction, bool(limit), bool(offset))
+        statement = cls.statement_cache.get(key, lambda: cls._build_select(*key[2:]))
+        query = statement.query
+        params = list(conditions.values()) if conditions else []
 
-        # Add LIMIT and OFFSET if provided
         if limit:
-            query += " LIMIT ?"
             params.append(limit)
 
         if offset:
-            query += " OFFSET ?"
             params.append(offset)
 
         rows = cls.execute_query(query, params)
@@ -268,31 +508,37 @@ class Database:
             if not rows:
                 return []
 
-            if not custom_select:
-                Row = namedtuple('Row', cls.columns)
-            else:
-                columns_part = custom_select.split('FROM')[0].replace('SELECT', '').strip()
-                # Split by commas and trim spaces
-                column_names = [col.strip() for col in columns_part.split(',')]
-                # Map each row's values to the corresponding column name
-                Row = namedtuple('Row', column_names)
-            rows = [Row(*row) for row in rows]
+            Row = cls._row_type(custom_select)
+            rows = [Row._make(row) for row in rows]
 
         if len(rows) == 1 and not force_2d:  # return as tuple instead of list of tuples
             return rows[0]
 
         return rows
 
+    @classmethod
+    def _build_where(cls, statement_start: str, columns: tuple) -> Statement:
+        cls.validate_columns(columns)
+        where_clause = ' AND '.join(f"{key} = ?" for key in columns)
+        return Statement(f"{statement_start} {cls.table_name} WHERE {where_clause}", columns)
+
+    @classmethod
+    def _build_update(cls, condition_columns: tuple, value_columns: tuple) -> Statement:
+        cls.validate_columns(condition_columns)
+        cls.validate_columns(value_columns)
+        set_clause = ', '.join(f"{key} = ?" for key in value_columns)
+        where_clause = ' AND '.join(f"{key} = ?" for key in condition_columns)
+        return Statement(f"UPDATE {cls.table_name} SET {set_clause} WHERE {where_clause}",
+                         value_columns + condition_columns)
+
     @classmethod
     def count_where(cls, conditions: dict):
         """Counts the number of records that meet the given conditions."""
         if not conditions:
             raise ValueError("No conditions provided for count.")
-        cls.validate_columns(conditions)
-
-        where_clause = ' AND '.join([f"{key} = ?" for key in conditions])
-        query = f"SELECT COUNT(*) FROM {cls.table_name} WHERE {where_clause}"
-        result = cls.execute_query(query, conditions.values())
+        statement = cls.statement_cache.get((cls.table_name, "count", tuple(conditions)),
+                                            lambda: cls._build_where("SELECT COUNT(*) FROM", tuple(conditions)))
+        result = cls.execute_query(statement.query, conditions.values())
         return result[0][0] if result else 0
 
     @classmethod
@@ -303,13 +549,9 @@ class Database:
         if not new_values:
             raise ValueError("No new values provided for update.")
 
-        cls.validate_columns(conditions)
-        cls.validate_columns(new_values)
-
-        set_clause = ', '.join(f"{key} = ?" for key in new_values)
-        where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
-        query = f"UPDATE {cls.table_name} SET {set_clause} WHERE {where_clause}"
-        cursor = cls.execute_query(query, (*new_values.values(), *conditions.values()))
+        statement = cls.statement_cache.get((cls.table_name, "set", tuple(conditions), tuple(new_values)),
+                                            lambda: cls._build_update(tuple(conditions), tuple(new_values)))
+        cursor = cls.execute_query(statement.query, (*new_values.values(), *conditions.values()))
         return cursor.rowcount > 0
 
     @classmethod
@@ -317,17 +559,15 @@ class Database:
         """Deletes records that meet the given conditions."""
         if not conditions:
             raise ValueError("No conditions provided for identifying the row(s) to delete.")
-        cls.validate_columns(conditions)
-
-        where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
-        query = f"DELETE FROM {cls.table_name} WHERE {where_clause}"
-        cursor = cls.execute_query(query, tuple(conditions.values()))
+        statement = cls.statement_cache.get((cls.table_name, "delete", tuple(conditions)),
+                                            lambda: cls._build_where("DELETE FROM", tuple(conditions)))
+        cursor = cls.execute_query(statement.query, tuple(conditions.values()))
         return cursor.rowcount > 0
 
 
 class Users(Database):
     table_name = "users"
-    columns = ["user_id", "username", "language", "timezone", "current_vocabulary_id", "hide_meaning"]
+    columns = ["user_id", "username", "language", "timezone", "current_vocabulary_id", "hide_meaning", "setup_complete"]
     create_table_query = '''
     CREATE TABLE IF NOT EXISTS users (
     user_id INTEGER PRIMARY KEY,
@@ -339,54 +579,110 @@ class Users(Database):
     FOREIGN KEY (current_vocabulary_id) REFERENCES vocabularies(vocabulary_id)
     );
     '''
+    trigger_setup_incomplete = """
+    CREATE TRIGGER IF NOT EXISTS reset_setup_complete_after_update
+    AFTER UPDATE OF language, current_vocabulary_id ON users
+    FOR EACH ROW
+    WHEN NEW.setup_complete AND (NEW.language IS NULL OR NEW.current_vocabulary_id IS NULL)
+    BEGIN
+        UPDATE users SET setup_complete = 0 WHERE user_id = NEW.user_id;
+    END;
+    """
+    migrations = (
+        (create_table_query,),
+        # set by the bot once a user finishes onboarding, reset by the trigger when setup becomes incomplete again,
+        # e.g. the last vocabulary is deleted. Existing users are marked on their next update
+        ("ALTER TABLE users ADD COLUMN setup_complete INTEGER NOT NULL DEFAULT 0;", trigger_setup_incomplete),
+    )
 
 
 class Vocabularies(Database):
     table_name = "vocabularies"
-    columns = ["vocabulary_id", "user_id", "vocabulary_name"]
+    columns = ["vocabulary_id", "user_id", "vocabulary_name", "word_count", "version"]
 
-    @classmethod
-    def create_table(cls) -> None:
-        create_table_query = """
-            CREATE TABLE IF NOT EXISTS vocabularies (
-            vocabulary_id INTEGER PRIMARY KEY,
-            user_id INTEGER NOT NULL,
-            vocabulary_name TEXT NOT NULL,
-            UNIQUE(vocabulary_name, user_id),
-            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-            );
-            """
-        cls.execute_query(create_table_query)
-
-        trigger_delete_vocabulary = """
-        CREATE TRIGGER update_current_vocabulary_after_delete
-        AFTER DELETE ON vocabularies
-        FOR EACH ROW
-        BEGIN
-            -- Update current_vocabulary_id to another existing vocabulary or leave as NULL
-            UPDATE users
-            SET current_vocabulary_id = (
-                SELECT vocabulary_id
-                FROM vocabularies
-                WHERE user_id = OLD.user_id
-                LIMIT 1
-            )
-            WHERE current_vocabulary_id = OLD.vocabulary_id;
-        END;
-        """
-        cls.execute_query(trigger_delete_vocabulary)
-
-        trigger_insert_vocabulary = """
-        CREATE TRIGGER set_current_vocabulary_after_insert
-        AFTER INSERT ON vocabularies
-        FOR EACH ROW
-        BEGIN
-            UPDATE users
-            SET current_vocabulary_id = NEW.vocabulary_id
-            WHERE user_id = NEW.user_id;
-        END;
-        """
-        cls.execute_query(trigger_insert_vocabulary)
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS vocabularies (
+    vocabulary_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    vocabulary_name TEXT NOT NULL,
+    UNIQUE(vocabulary_name, user_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    );
+    """
+    trigger_delete_vocabulary = """
+    CREATE TRIGGER IF NOT EXISTS update_current_vocabulary_after_delete
+    AFTER DELETE ON vocabularies
+    FOR EACH ROW
+    BEGIN
+        -- Update current_vocabulary_id to another existing vocabulary or leave as NULL
+        UPDATE users
+        SET current_vocabulary_id = (
+            SELECT vocabulary_id
+            FROM vocabularies
+            WHERE user_id = OLD.user_id
+            LIMIT 1
+        )
+        WHERE current_vocabulary_id = OLD.vocabulary_id;
+    END;
+    """
+    trigger_insert_vocabulary = """
+    CREATE TRIGGER IF NOT EXISTS set_current_vocabulary_after_insert
+    AFTER INSERT ON vocabularies
+    FOR EACH ROW
+    BEGIN
+        UPDATE users
+        SET current_vocabulary_id = NEW.vocabulary_id
+        WHERE user_id = NEW.user_id;
+    END;
+    """
+    trigger_rename_vocabulary = """
+    CREATE TRIGGER IF NOT EXISTS bump_vocabulary_version_after_rename
+    AFTER UPDATE OF vocabulary_name ON vocabularies
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies SET version = version + 1 WHERE vocabulary_id = NEW.vocabulary_id;
+    END;
+    """
+    create_versions_query = """
+    CREATE TABLE IF NOT EXISTS vocabulary_versions (
+    max_deleted_version INTEGER NOT NULL
+    );
+    """
+    trigger_keep_deleted_version = """
+    CREATE TRIGGER IF NOT EXISTS keep_version_after_delete
+    AFTER DELETE ON vocabularies
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabulary_versions SET max_deleted_version = MAX(max_deleted_version, OLD.version);
+    END;
+    """
+    trigger_start_version = """
+    CREATE TRIGGER IF NOT EXISTS start_version_after_insert
+    AFTER INSERT ON vocabularies
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies
+        SET version = (SELECT max_deleted_version + 1 FROM vocabulary_versions)
+        WHERE vocabulary_id = NEW.vocabulary_id;
+    END;
+    """
+    indexes = (
+        # vocabularies of a user, UNIQUE(vocabulary_name, user_id) can't serve lookups by user_id alone
+        "CREATE INDEX IF NOT EXISTS idx_vocabularies_user ON vocabularies(user_id, vocabulary_id);",
+    )
+    migrations = (
+        (create_table_query, trigger_delete_vocabulary, trigger_insert_vocabulary),
+        # number of words in the vocabulary, maintained by triggers on words
+        ("ALTER TABLE vocabularies ADD COLUMN word_count INTEGER NOT NULL DEFAULT 0;",),
+        # bumped by triggers on words whenever the word list changes, lets caches of rendered words detect staleness
+        ("ALTER TABLE vocabularies ADD COLUMN version INTEGER NOT NULL DEFAULT 0;",),
+        (trigger_rename_vocabulary,),
+        indexes,
+        # vocabulary_id of the last vocabulary is reused after it's deleted, so a new vocabulary starts above every
+        # version a deleted one reached, and (vocabulary_id, version) never identifies two different word lists
+        (create_versions_query, "INSERT INTO vocabulary_versions (max_deleted_version) VALUES (0);",
+         trigger_keep_deleted_version, trigger_start_version),
+    )
 
 
 class Words(Database):
@@ -405,6 +701,81 @@ class Words(Database):
     FOREIGN KEY (vocabulary_id) REFERENCES vocabularies(vocabulary_id) ON DELETE CASCADE
     );
     '''
+    indexes = (
+        # oldest words of a vocabulary for recall
+        "CREATE INDEX IF NOT EXISTS idx_words_user_vocabulary_timestamp ON words(user_id, vocabulary_id, timestamp);",
+        # word counts and word lists of a vocabulary, rows come out ordered by word_id
+        "CREATE INDEX IF NOT EXISTS idx_words_vocabulary ON words(vocabulary_id);",
+    )
+    count_words = """
+    UPDATE vocabularies
+    SET word_count = (
+        SELECT COUNT(*)
+        FROM words
+        WHERE words.vocabulary_id = vocabularies.vocabulary_id
+    );
+    """
+    trigger_insert_word = """
+    CREATE TRIGGER IF NOT EXISTS increment_word_count_after_insert
+    AFTER INSERT ON words
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies
+        SET word_count = word_count + 1
+        WHERE vocabulary_id = NEW.vocabulary_id;
+    END;
+    """
+    trigger_delete_word = """
+    CREATE TRIGGER IF NOT EXISTS decrement_word_count_after_delete
+    AFTER DELETE ON words
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies
+        SET word_count = word_count - 1
+        WHERE vocabulary_id = OLD.vocabulary_id;
+    END;
+    """
+    trigger_move_word = """
+    CREATE TRIGGER IF NOT EXISTS move_word_count_after_update
+    AFTER UPDATE OF vocabulary_id ON words
+    FOR EACH ROW
+    WHEN OLD.vocabulary_id != NEW.vocabulary_id
+    BEGIN
+        UPDATE vocabularies SET word_count = word_count - 1 WHERE vocabulary_id = OLD.vocabulary_id;
+        UPDATE vocabularies SET word_count = word_count + 1 WHERE vocabulary_id = NEW.vocabulary_id;
+    END;
+    """
+    trigger_version_after_insert = """
+    CREATE TRIGGER IF NOT EXISTS bump_vocabulary_version_after_insert
+    AFTER INSERT ON words
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies SET version = version + 1 WHERE vocabulary_id = NEW.vocabulary_id;
+    END;
+    """
+    trigger_version_after_delete = """
+    CREATE TRIGGER IF NOT EXISTS bump_vocabulary_version_after_delete
+    AFTER DELETE ON words
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies SET version = version + 1 WHERE vocabulary_id = OLD.vocabulary_id;
+    END;
+    """
+    trigger_version_after_update = """
+    CREATE TRIGGER IF NOT EXISTS bump_vocabulary_version_after_update
+    AFTER UPDATE OF vocabulary_id, word, meaning ON words
+    FOR EACH ROW
+    BEGIN
+        UPDATE vocabularies SET version = version + 1 WHERE vocabulary_id IN (OLD.vocabulary_id, NEW.vocabulary_id);
+    END;
+    """
+    migrations = (
+        (create_table_query,),
+        indexes,
+        # columns of vocabularies are added by the vocabularies migrations, which always run before these
+        (count_words, trigger_insert_word, trigger_delete_word, trigger_move_word),
+        (trigger_version_after_insert, trigger_version_after_delete, trigger_version_after_update),
+    )
 
 
 class Reminders(Database):
@@ -422,11 +793,19 @@ class Reminders(Database):
         FOREIGN KEY (vocabulary_id) REFERENCES vocabularies(vocabulary_id) ON DELETE CASCADE
     );
     '''
+    indexes = (
+        # reminders due at a given minute
+        "CREATE INDEX IF NOT EXISTS idx_reminders_time ON reminders(time);",
+    )
+    migrations = (
+        (create_table_query,),
+        indexes,
+    )
 
 
 class Temp(Database):
     table_name = "temp"
-    columns = ["user_id", "key", "value"]
+    columns = ["user_id", "key", "value", "expires_at"]
     create_table_query = """
     CREATE TABLE IF NOT EXISTS temp (
         user_id INTEGER,
@@ -436,7 +815,122 @@ class Temp(Database):
         FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
     );
     """
+    indexes = (
+        # expired entries for the sweeper, entries that never expire aren't indexed
+        "CREATE INDEX IF NOT EXISTS idx_temp_expires_at ON temp(expires_at) WHERE expires_at IS NOT NULL;",
+    )
+    migrations = (
+        (create_table_query,),
+        # unix time after which the entry is treated as absent, NULL for entries that never expire
+        ("ALTER TABLE temp ADD COLUMN expires_at INTEGER;",) + indexes,
+    )
 
     @classmethod
     def add(cls, data: dict, replace: bool = True):
         return super().add(data, replace=replace)
+
+    @classmethod
+    def delete_expired(cls, now: int, limit: int) -> int:
+        """
+        Deletes at most `limit` entries that expired by `now`, so a single call holds the write lock only briefly.
+
+        :return: Number of deleted entries
+        """
+        cursor = cls.execute_query("""
+        DELETE FROM temp
+        WHERE rowid IN (
+            SELECT rowid FROM temp
+            WHERE expires_at <= ?
+            LIMIT ?
+        );
+        """, (now, limit))
+        return max(cursor.rowcount, 0)
+
+
+class BroadcastJobs(Database):
+    table_name = "broadcast_jobs"
+    columns = ["job_id", "text", "reply_markup", "exceptions", "status", "last_user_id", "total", "sent", "blocked",
+               "failed", "created_at", "updated_at", "claim"]
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        job_id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL,  -- JSON, a string or {language: string}
+        reply_markup TEXT,  -- JSON
+        exceptions TEXT NOT NULL DEFAULT '[]',  -- JSON list of user_ids that don't receive the broadcast
+        status TEXT NOT NULL DEFAULT 'running',  -- running, finished or failed
+        last_user_id INTEGER NOT NULL DEFAULT 0,  -- users are processed in user_id order, resumed after this one
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    );
+    """
+    migrations = (
+        (create_table_query,),
+        # token of the runner that owns the job, changed when a job is resumed so the previous runner stops writing
+        ("ALTER TABLE broadcast_jobs ADD COLUMN claim TEXT;",),
+    )
+
+
+class BroadcastRecipients(Database):
+    table_name = "broadcast_recipients"
+    columns = ["job_id", "user_id", "status"]
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        job_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,  -- sent, blocked or failed
+        PRIMARY KEY (job_id, user_id),
+        FOREIGN KEY (job_id) REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE
+    );
+    """
+    migrations = (
+        (create_table_query,),
+    )
+
+
+class SeenUpdates(Database):
+    table_name = "seen_updates"
+    columns = ["update_id", "seen_at"]
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS seen_updates (
+        update_id INTEGER PRIMARY KEY,
+        seen_at INTEGER NOT NULL
+    );
+    """
+    migrations = (
+        (create_table_query,),
+    )
+
+    @classmethod
+    def mark_seen(cls, update_id: int, now: int) -> bool:
+        """
+        Records the update as seen.
+
+        :return: False if it has been seen before
+        """
+        cursor = cls.execute_query("INSERT OR IGNORE INTO seen_updates (update_id, seen_at) VALUES (?, ?);",
+                                   (update_id, now))
+        return cursor.rowcount > 0
+
+    @classmethod
+    def delete_older_than(cls, seen_at: int) -> int:
+        cursor = cls.execute_query("DELETE FROM seen_updates WHERE seen_at < ?;", (seen_at,))
+        return max(cursor.rowcount, 0)
+
+
+TABLES = (Users, Vocabularies, Words, Reminders, Temp, BroadcastJobs, BroadcastRecipients, SeenUpdates)
+
+
+def migrate():
+    """Brings the schema of all tables up to date. Called once at startup, before any update is processed."""
+    Database.execute_query("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        table_name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    """)
+    for table in TABLES:
+        table.migrate()
@@ -1,14 +1,22 @@
 from flask import Flask, request, jsonify
 from bot import Bot, telepot
+import database as db
 import urllib3
 from urllib3.util.retry import Retry
-from time import sleep
-from bot._words import recall
+from bot._words import recall, word_page_index, rendered_word_pages
 from bot._reminders import _get_reminders_list_at
+from bot.update_pool import UpdateWorkerPool
+from bot.temp_manager import user_parameters, temp_store, run_temp_sweeper
 from bot.utils import get_hh_mm, shift_time
-from logger import setup_logger, process_logs
+from logger import setup_logger, process_logs, log_queue_stats
 import os
+import atexit
+import threading
 from dotenv import load_dotenv
+try:
+    import uwsgi  # only importable inside uWSGI, which serves web apps on PythonAnywhere
+except ImportError:
+    uwsgi = None
 
 
 logger = setup_logger(__name__)
@@ -43,9 +51,28 @@ telepot.api._onetime_pool_spec = (urllib3.ProxyManager, dict(proxy_url=proxy_url
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 SECRET = os.getenv("SECRET")
 SITE = os.getenv("SITE_URL")
+DISPATCHER_SHUTDOWN_TIMEOUT = 10  # seconds
+UPDATE_POOL_SHUTDOWN_TIMEOUT = 10  # seconds
+WEBHOOK_MAX_CONNECTIONS = 40  # concurrent deliveries from Telegram, cheap now that the webhook only queues updates
+
+# Temp values, user parameters, per-user update order and rate limits are all kept in memory of this process, a second
+# worker would route updates by stale state and break ordering, so the app must be served by a single process
+if uwsgi is not None and uwsgi.numproc > 1:
+    raise RuntimeError(f"The bot must run in a single worker process, uWSGI started {uwsgi.numproc}")
+
+db.migrate()
+
+background_stop = threading.Event()
+threading.Thread(target=run_temp_sweeper, args=(background_stop,), name="temp-sweeper", daemon=True).start()
 
 bot = Bot(TOKEN)
-bot.setWebhook(SITE + SECRET, max_connections=1)
+update_pool = UpdateWorkerPool(bot.handle_update)
+# exit handlers run in reverse order: updates are processed first, so the messages they queue are sent too
+atexit.register(bot.dispatcher.close, timeout=DISPATCHER_SHUTDOWN_TIMEOUT)
+atexit.register(update_pool.close, timeout=UPDATE_POOL_SHUTDOWN_TIMEOUT)
+threading.Thread(target=bot.broadcasts.run_resumer, args=(background_stop,), name="broadcast-resumer",
+                 daemon=True).start()
+bot.setWebhook(SITE + SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
 
 app = Flask(__name__)
 
@@ -53,7 +80,9 @@ app = Flask(__name__)
 @app.route(f'/{SECRET}', methods=["POST"])
 def telegram_webhook():
     update = request.get_json()
-    bot.handle_update(update)
+    if not update_pool.submit(update):
+        logger.warning("Update queue is full, update refused")
+        return "Busy", 503  # Telegram delivers it again later
     return "OK"
 
 
@@ -62,6 +91,40 @@ def view_logs():
     return process_logs()
 
 
+@app.route(f'/{SECRET}/stats', methods=["GET"])
+def view_stats():
+    return jsonify({
+        "updates": bot.update_stats(),
+        "update_pool": update_pool.stats(),
+        "deduplicator": bot.deduplicator.stats(),
+        "log_queue": log_queue_stats(),
+        "dispatcher": bot.dispatcher.stats(),
+        "statement_cache": db.Database.statement_cache.stats(),
+        "word_page_index": word_page_index.stats(),
+        "rendered_word_pages": rendered_word_pages.stats(),
+        "user_parameters": user_parameters.stats(),
+        "temp_store": temp_store.stats(),
+    })
+
+
+@app.route(f'/{SECRET}/broadcasts', methods=["POST"])
+def start_broadcast():
+    data = request.get_json()
+    if not data or not data.get("text"):
+        return jsonify({"status": "error", "message": "No text provided."}), 400
+
+    job_id = bot.broadcasts.start(data["text"], data.get("reply_markup"), data.get("exceptions"))
+    return jsonify({"status": "success", "job_id": job_id}), 202
+
+
+@app.route(f'/{SECRET}/broadcasts/<int:job_id>', methods=["GET"])
+def broadcast_progress(job_id):
+    progress = bot.broadcasts.progress(job_id)
+    if progress is None:
+        return jsonify({"status": "error", "message": "No such broadcast."}), 404
+    return jsonify(progress)
+
+
 last_reminded_at = None
 
 
@@ -80,16 +143,13 @@ def remind_all():
             if len(reminders) > 0:
                 for _, user, vocabulary_id, _, number_of_words in reminders:
                     text, reply_markup = recall(user=user, vocabulary_id=vocabulary_id, limit=number_of_words)
-                    bot.deliver_message(user, text, reply_markup=reply_markup)
+                    bot.deliver_message(user, text, reply_markup=reply_markup)  # paced by the dispatcher
                     reminders_count += 1
-
-                    if reminders_count > 0 and reminders_count % 30 == 0:  # Telegram allows 30 messages per second
-                        sleep(1)
             time = shift_time(time, min_offset=1)
 
         last_reminded_at = current_time
         if reminders_count > 0:
-            return jsonify({"status": "success", "message": f"{reminders_count} reminders sent successfully!"}), 200
+            return jsonify({"status": "success", "message": f"{reminders_count} reminders queued successfully!"}), 200
         else:
             return jsonify({"status": "success", "message": "No reminders found"}), 200
 
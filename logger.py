@@ -1,5 +1,8 @@
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from collections import deque
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import os
 import threading
 
@@ -8,34 +11,104 @@ LOG_PATH = os.path.join(os.path.expanduser("~"), 'mysite', 'logs')
 os.makedirs(LOG_PATH, exist_ok=True)
 
 LOG_FILE = os.path.join(LOG_PATH, 'app.log')
+DEBUG_LOG_DEPTH = int(os.getenv("DEBUG_LOG_DEPTH", 1000))  # DEBUG records kept per thread for flushing after an error
+LOG_QUEUE_SIZE = 10_000  # records waiting to be written
+LOG_QUEUE_BLOCK_TIMEOUT = 1  # seconds a WARNING or more important record waits for space in a full queue
 
 # Thread-local storage for per-update debug logs
 thread_local = threading.local()
-show_debug = False  # controls debug showing in logs
+log_queue_handler = None  # set by setup_logger
 
 
-def set_show_debug(value: bool):
-    global show_debug
-    show_debug = value
+class Lazy:
+    """
+    Log argument computed only when the record is formatted, for values expensive to build, e.g.
+    logger.debug("Update: %s", Lazy(json.dumps, update, indent=4)). DEBUG records are usually discarded unformatted.
+    """
+    __slots__ = ("func", "args", "kwargs")
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
 
 
 class DebugLogFilter(logging.Filter):
-    """Custom filter to store DEBUG logs per Telegram update in thread-local storage."""
+    """
+    Custom filter to store DEBUG records per Telegram update in thread-local storage. Records are kept unformatted,
+    so their messages are only built if they are flushed after an error, and only the last DEBUG_LOG_DEPTH of them are
+    kept, so threads that never flush, like background workers, don't accumulate them.
+    """
     def filter(self, record):
         if record.levelno == logging.DEBUG:
-            # Check if we should show debug logs
-            if show_debug:
-                return True  # Allow DEBUG logs to be logged to the output
-
-            # Otherwise, store them in thread-local storage
+            # Store them in thread-local storage
             if not hasattr(thread_local, "debug_log_stack"):
-                thread_local.debug_log_stack = []
-            log_entry = f"{record.getMessage()} [in {record.pathname}:{record.lineno}]"
-            thread_local.debug_log_stack.append(log_entry)  # Store formatted log
+                reset_debug_log()
+            thread_local.debug_log_stack.append(record)  # the oldest record is dropped when the buffer is full
+            thread_local.debug_log_count += 1
             return False  # Prevent DEBUG log from being processed normally
         return True  # Allow all other log levels
 
 
+def reset_debug_log(depth: int = None):
+    """Starts a new debug capture for the current thread, e.g. for a new update."""
+    thread_local.debug_log_stack = deque(maxlen=depth or DEBUG_LOG_DEPTH)
+    thread_local.debug_log_count = 0  # records captured, including dropped ones
+
+
+def flush_debug_log(logger):
+    """Emits the captured DEBUG records of the current thread, oldest first, and clears them."""
+    records = getattr(thread_local, "debug_log_stack", None)
+    if not records:
+        return
+
+    dropped = thread_local.debug_log_count - len(records)
+    logger.info(f"Debug log before crash ({dropped} earlier records dropped):" if dropped else
+                "Debug log before crash:", stacklevel=2)
+    for record in records:
+        logger.callHandlers(record)  # past the logger's filter, which would capture the record again
+    reset_debug_log(records.maxlen)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records into a bounded queue for a QueueListener. When the queue is full, records below WARNING are dropped
+    and counted, while more important ones wait up to LOG_QUEUE_BLOCK_TIMEOUT seconds for space before being dropped.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """
+        Merges args into the message, so the record doesn't depend on objects that may change before it is written.
+        Unlike QueueHandler.prepare, leaves formatting, including tracebacks, to the listener thread.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if record.levelno >= logging.WARNING:
+            try:
+                self.queue.put(record, timeout=LOG_QUEUE_BLOCK_TIMEOUT)
+                return
+            except queue.Full:
+                pass
+        with self._dropped_lock:
+            self.dropped += 1
+
+
 def setup_logger(name):
     logger = logging.getLogger("main_logger")  # Use a single global name
     if logger.hasHandlers():
@@ -47,23 +120,36 @@ def setup_logger(name):
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.DEBUG)
 
-    # Add debug log filter
-    debug_filter = DebugLogFilter()
-    file_handler.addFilter(debug_filter)
-
     console_handler = logging.StreamHandler()
     console_formatter = logging.Formatter('%(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
     console_handler.setFormatter(console_formatter)
     console_handler.setLevel(logging.DEBUG)
 
+    # handlers run in a listener thread, so callers only put records into a queue and never wait for file I/O
+    global log_queue_handler
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    log_queue_handler = BoundedQueueHandler(log_queue)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # writes out queued records before exiting
+
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    logger.addFilter(DebugLogFilter())  # on the logger, so each record is captured once rather than per handler
+    logger.addHandler(log_queue_handler)
     logger.propagate = False
 
     return logger
 
 
+def log_queue_stats():
+    if log_queue_handler is None:
+        return {}
+    return {
+        "queued": log_queue_handler.queue.qsize(),
+        "dropped": log_queue_handler.dropped,
+    }
+
+
 def clean_line(line):
     return ''.join(char for char in line if char.isprintable())
 
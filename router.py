@@ -16,7 +16,7 @@ def route(trigger, action, state=None, query_action=None, command=None, cancel_b
             FuncInfo = namedtuple('FuncInfo', ['call', 'required_action', 'cancel_button'])
             key = trigger, state, query_action, command
             routes[key] = FuncInfo(func, action, cancel_button)
-            logger.debug(f"Added route {func.__name__} by key: {key}")
+            logger.debug("Added route %s by key: %s", func.__name__, key)
             return func
         else:
             raise ValueError("Invalid arguments")
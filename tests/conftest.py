@@ -0,0 +1,33 @@
+import os
+import tempfile
+
+import pytest
+
+# database and logger create their files under ~/mysite on import, keep them away from a real deployment
+os.environ["HOME"] = tempfile.mkdtemp()
+os.makedirs(os.path.join(os.environ["HOME"], "mysite"))
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """database module connected to a fresh, fully migrated database in a temporary home directory."""
+    monkeypatch.setenv("HOME", str(tmp_path))
+    (tmp_path / "mysite").mkdir()
+    import database
+
+    pool = database.ConnectionPool("test.db", timeout=database.BUSY_TIMEOUT)
+    monkeypatch.setattr(database.Database, "connection", pool)
+    database.migrate()
+    yield database
+    pool.close()
+
+
+@pytest.fixture
+def temp_manager(db, monkeypatch):
+    """bot.temp_manager with empty caches, so nothing cached by another test is seen."""
+    from bot import temp_manager
+    from bot.cache import LRUCache
+
+    monkeypatch.setattr(temp_manager, "temp_store", temp_manager.TempStore(temp_manager.TEMP_CACHE_SIZE))
+    monkeypatch.setattr(temp_manager, "user_parameters", LRUCache(temp_manager.USER_PARAMETERS_CACHE_SIZE))
+    return temp_manager
@@ -0,0 +1,94 @@
+import threading
+from concurrent.futures import Future
+
+import pytest
+from telepot.exception import BotWasBlockedError
+
+
+class Delivery:
+    """deliver_message stand-in, its futures are resolved by the test or, if `immediately`, right away."""
+    def __init__(self, immediately=True, blocked=(), users=5):
+        self.immediately = immediately
+        self.blocked = set(blocked)
+        self.users = users
+        self.futures = {}
+        self.queued = threading.Event()  # set once every user's message is queued
+
+    def __call__(self, user, message, reply_markup=None):
+        future = Future()
+        self.futures[user] = future
+        if self.immediately:
+            self.resolve(user)
+        if len(self.futures) == self.users:
+            self.queued.set()
+        return future
+
+    def resolve(self, user):
+        if user in self.blocked:
+            self.futures[user].set_exception(BotWasBlockedError("Forbidden", 403, {}))
+        else:
+            self.futures[user].set_result({"message_id": user})
+
+
+@pytest.fixture
+def broadcasts(db):
+    from bot import broadcasts
+
+    for user in range(1, 6):
+        db.Users.add({"user_id": user, "username": str(user), "language": "en"})
+    return broadcasts
+
+
+def run(broadcasts, delivery, **kwargs):
+    manager = broadcasts.BroadcastManager(delivery)
+    job_id = manager.start("hi", **kwargs)
+    return manager, job_id
+
+
+def take_over(db, job_id):
+    db.BroadcastJobs.execute_query("UPDATE broadcast_jobs SET claim = 'other' WHERE job_id = ?;", (job_id,))
+
+
+def recipients(db, job_id):
+    return db.BroadcastRecipients.execute_query("SELECT user_id, status FROM broadcast_recipients WHERE job_id = ? "
+                                                "ORDER BY user_id;", (job_id,))
+
+
+def test_broadcast_skips_exceptions_and_finishes(db, broadcasts):
+    manager, job_id = run(broadcasts, Delivery(blocked={3}), exceptions=[2])
+    manager._threads[job_id].join(5)
+
+    progress = manager.progress(job_id)
+    assert (progress["status"], progress["total"], progress["sent"], progress["blocked"]) == ("finished", 4, 3, 1)
+    assert progress["progress"] == 1.0
+    assert [tuple(row) for row in recipients(db, job_id)] == [(1, "sent"), (3, "blocked"), (4, "sent"), (5, "sent")]
+
+
+def test_runner_taken_over_while_waiting_for_a_batch_stops_without_writing(db, broadcasts, monkeypatch):
+    monkeypatch.setattr(broadcasts, "BROADCAST_LEASE_RENEWAL", 0.05)
+    delivery = Delivery(immediately=False)
+    manager, job_id = run(broadcasts, delivery)
+    assert delivery.queued.wait(5)
+    take_over(db, job_id)
+    manager._threads[job_id].join(5)
+
+    assert not manager._threads[job_id].is_alive()
+    assert all(future.cancelled() for future in delivery.futures.values())
+    progress = manager.progress(job_id)
+    assert (progress["status"], progress["processed"]) == ("running", 0)
+    assert not recipients(db, job_id)
+
+
+def test_runner_taken_over_before_its_checkpoint_stops_without_writing(db, broadcasts):
+    delivery = Delivery(immediately=False)
+    manager, job_id = run(broadcasts, delivery)
+    assert delivery.queued.wait(5)
+    take_over(db, job_id)
+    for user in delivery.futures:  # the batch completes only after the job has been claimed by another runner
+        delivery.resolve(user)
+    manager._threads[job_id].join(5)
+
+    assert not manager._threads[job_id].is_alive()
+    progress = manager.progress(job_id)
+    assert (progress["status"], progress["processed"]) == ("running", 0)
+    assert not recipients(db, job_id)
@@ -0,0 +1,49 @@
+import pytest
+
+
+def query_plan(db, query, params):
+    return [row[3] for row in db.Database.connection.writer.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+
+@pytest.mark.parametrize("query, params, index", [
+    # recall, oldest words of a vocabulary
+    ("SELECT word_id, word, meaning FROM words WHERE user_id = ? AND vocabulary_id = ? ORDER BY timestamp ASC "
+     "LIMIT ?", (1, 1, 15), "idx_words_user_vocabulary_timestamp"),
+    # word count of a vocabulary
+    ("SELECT COUNT(*) FROM words WHERE vocabulary_id = ?", (1,), "idx_words_vocabulary"),
+    # word page by word_id range
+    ("SELECT word, meaning FROM words WHERE user_id = ? AND vocabulary_id = ? AND word_id BETWEEN ? AND ? "
+     "ORDER BY word_id ASC", (1, 1, 1, 100), "idx_words_vocabulary"),
+    # reminders due at a given minute
+    ("SELECT * FROM reminders WHERE time = ?", ("08:00",), "idx_reminders_time"),
+    # vocabularies of a user with word counts, for the vocabulary page, vocabulary keyboards and reminders page
+    ("SELECT vocabulary_id, vocabulary_name, word_count FROM vocabularies WHERE user_id = ? "
+     "ORDER BY vocabulary_id ASC", (1,), "idx_vocabularies_user"),
+])
+def test_hot_queries_use_indexes(db, query, params, index):
+    plan = query_plan(db, query, params)
+    assert any(step.startswith("SEARCH") for step in plan), plan
+    assert not any(step.startswith("SCAN") for step in plan), plan
+    assert any(index in step for step in plan), plan
+
+
+def add_vocabulary(db, user, name, words=0):
+    _, vocabulary_id = db.Vocabularies.add({"user_id": user, "vocabulary_name": name})
+    for i in range(words):
+        db.Words.add({"user_id": user, "vocabulary_id": vocabulary_id, "word": f"{name}{i}", "timestamp": i})
+    return vocabulary_id, db.Vocabularies.get({"vocabulary_id": vocabulary_id}, include_column_names=True).version
+
+
+@pytest.mark.parametrize("delete", [
+    lambda db: db.Vocabularies.delete({"vocabulary_id": 1}),
+    lambda db: db.Users.delete({"user_id": 1}),  # vocabularies are deleted by cascade
+])
+def test_reused_vocabulary_id_starts_above_deleted_versions(db, delete):
+    db.Users.add({"user_id": 1, "username": "a"})
+    db.Users.add({"user_id": 2, "username": "b"})
+    old_id, old_version = add_vocabulary(db, 1, "old", words=2)
+    delete(db)
+
+    new_id, new_version = add_vocabulary(db, 2, "new")
+    assert new_id == old_id
+    assert new_version > old_version
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from bot.dedup import UpdateDeduplicator
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+def update(update_id):
+    return {"update_id": update_id, "message": {"chat": {"id": 1}, "text": "x"}}
+
+
+def test_redelivery_within_the_window_is_a_duplicate(clock):
+    deduplicator = UpdateDeduplicator(window=60)
+    assert not deduplicator.is_duplicate(update(1))
+    clock[0] += 59
+    assert deduplicator.is_duplicate(update(1))
+    assert not deduplicator.is_duplicate(update(2))
+    assert deduplicator.stats() == {"remembered": 2, "duplicates": 1}
+
+
+def test_update_is_forgotten_after_the_window(clock):
+    deduplicator = UpdateDeduplicator(window=60)
+    deduplicator.is_duplicate(update(1))
+    clock[0] += 30
+    deduplicator.is_duplicate(update(2))
+    clock[0] += 30
+
+    assert not deduplicator.is_duplicate(update(1))  # expired and remembered again
+    assert deduplicator.stats()["remembered"] == 2  # 2 is still within the window
+
+
+def test_oldest_updates_are_evicted_beyond_the_cap(clock):
+    deduplicator = UpdateDeduplicator(window=60, max_entries=3)
+    for update_id in range(1, 5):
+        deduplicator.is_duplicate(update(update_id))
+
+    assert deduplicator.stats()["remembered"] == 3
+    assert deduplicator.is_duplicate(update(4))
+    assert not deduplicator.is_duplicate(update(1))
+
+
+def test_updates_without_id_are_never_duplicates():
+    deduplicator = UpdateDeduplicator()
+    assert not deduplicator.is_duplicate({})
+    assert not deduplicator.is_duplicate({})
+
+
+def test_persisted_updates_are_recognized_after_a_restart(db, clock):
+    UpdateDeduplicator(window=60, persist=True).is_duplicate(update(1))
+    assert UpdateDeduplicator(window=60, persist=True).is_duplicate(update(1))
+    assert not UpdateDeduplicator(window=60).is_duplicate(update(1))  # in memory only by default
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+from telepot.exception import TooManyRequestsError
+
+from bot.dispatcher import MessageDispatcher, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refills_at_its_rate(clock):
+    bucket = TokenBucket(rate=1, capacity=3)
+    assert [bucket.try_consume() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_consume() == pytest.approx(1)
+
+    clock.now += 0.5
+    assert bucket.try_consume() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_consume() == 0
+
+    clock.now += 60  # idle for long, but never more than capacity
+    assert [bucket.try_consume() for _ in range(4)][-1] > 0
+
+
+class Sender:
+    """Telegram request stand-in that records when and what was sent."""
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def __call__(self, chat_id, text):
+        with self._lock:
+            self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+def test_chat_gets_a_burst_then_is_paced_at_its_rate():
+    sender = Sender()
+    dispatcher = MessageDispatcher(workers=4, global_rate=1000, per_chat_rate=10, per_chat_burst=2)
+    futures = [dispatcher.submit(1, sender, 1, i) for i in range(6)]
+    assert [future.result(5) for future in futures] == list(range(6))
+    dispatcher.close(timeout=5)
+
+    times = [sent_at for _, _, sent_at in sender.sent]
+    assert times[1] - times[0] < 0.05  # burst
+    gaps = [later - earlier for earlier, later in zip(times[2:], times[3:])]
+    assert all(gap >= 0.09 for gap in gaps), gaps
+    assert times[-1] - times[0] >= 0.35
+
+
+def test_requests_to_a_chat_keep_their_order_and_other_chats_are_not_held_back():
+    sender = Sender()
+    dispatcher = MessageDispatcher(workers=4, global_rate=1000, per_chat_rate=5, per_chat_burst=1)
+    for i in range(5):
+        dispatcher.submit(1, sender, 1, i)
+    last = dispatcher.submit(2, sender, 2, 0)
+    last.result(5)
+    dispatcher.close(timeout=5)
+
+    assert [text for chat_id, text, _ in sender.sent if chat_id == 1] == list(range(5))
+    # chat 2 is sent right away instead of after chat 1's paced queue
+    assert [chat_id for chat_id, _, _ in sender.sent].index(2) <= 1
+    assert dispatcher.stats()["sent"] == 6
+
+
+def test_rate_limited_request_is_retried():
+    attempts = []
+
+    def send(text):
+        attempts.append(text)
+        if len(attempts) == 1:
+            raise TooManyRequestsError("Too Many Requests", 429, {"parameters": {"retry_after": 0}})
+        return text
+
+    dispatcher = MessageDispatcher(workers=1)
+    assert dispatcher.submit(1, send, "hi").result(5) == "hi"
+    dispatcher.close(timeout=5)
+
+    assert attempts == ["hi", "hi"]
+    assert dispatcher.stats()["rate_limited"] == 1
+    assert dispatcher.stats()["sent"] == 1
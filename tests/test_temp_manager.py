@@ -0,0 +1,32 @@
+import pytest
+from bot._enums import TEMP_KEYS
+
+
+@pytest.fixture
+def user(db):
+    db.Users.add({"user_id": 1, "username": "a"})
+    return 1
+
+
+def test_temp_survives_reload(temp_manager, user):
+    temp_manager.set_temp(user, TEMP_KEYS.STATE.value, 5)
+    temp_manager.invalidate_cached_temp(user)  # as after a restart, an eviction or a failed update
+
+    assert temp_manager.get_temp(user, TEMP_KEYS.STATE.value) == "5"
+    assert temp_manager.remove_temp(user, TEMP_KEYS.STATE.value) == temp_manager.TaskStatus.SUCCESS
+    assert temp_manager.get_temp(user, TEMP_KEYS.STATE.value) is None
+
+    temp_manager.invalidate_cached_temp(user)
+    assert temp_manager.get_temp(user, TEMP_KEYS.STATE.value) is None  # the row has been deleted too
+
+
+def test_missing_timezone_survives_reload(temp_manager, db, user):
+    db.Users.set({"user_id": user}, {"language": "en"})
+    db.Vocabularies.add({"user_id": user, "vocabulary_name": "a"})  # becomes the current vocabulary
+    temp_manager.set_temp(user, TEMP_KEYS.TIMEZONE_NOT_SET.value, 1, ttl=None)
+    assert temp_manager.check_missing_setup(user) == "timezone"
+
+    temp_manager.invalidate_cached_temp(user)
+    temp_manager.invalidate_cached_parameters(user)
+    assert temp_manager.check_missing_setup(user) == "timezone"
+    assert not db.Users.get({"user_id": user}, include_column_names=True).setup_complete
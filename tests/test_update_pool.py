@@ -0,0 +1,80 @@
+import threading
+import time
+from bot.update_pool import UpdateWorkerPool
+
+
+def message(user, update_id):
+    return {"update_id": update_id, "message": {"chat": {"id": user}, "from": {"id": user}, "text": "x"}}
+
+
+class Recorder:
+    """handle_update that records update_ids and can hold workers until released."""
+    def __init__(self):
+        self.handled = []
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+
+    def __call__(self, update):
+        self.release.wait(5)
+        with self._lock:
+            self.handled.append(update["update_id"])
+
+
+def test_updates_of_a_user_are_processed_in_update_id_order():
+    recorder = Recorder()
+    recorder.release.clear()
+    pool = UpdateWorkerPool(recorder, workers=4)
+    pool.submit(message(1, 1))  # taken by a worker, which waits
+    for update_id in (5, 3, 4, 2):  # concurrent deliveries arrive in any order
+        pool.submit(message(1, update_id))
+    recorder.release.set()
+    pool.close(timeout=5)
+
+    assert recorder.handled == [1, 2, 3, 4, 5]
+
+
+def test_updates_beyond_the_limit_are_refused():
+    recorder = Recorder()
+    recorder.release.clear()
+    pool = UpdateWorkerPool(recorder, workers=1, max_queued=2)
+    pool.submit(message(1, 1))
+    deadline = time.monotonic() + 5
+    while pool.stats()["processing"] == 0 and time.monotonic() < deadline:  # until the worker holds the first update
+        pass
+
+    assert pool.submit(message(1, 2))
+    assert pool.submit(message(2, 3))
+    assert not pool.submit(message(3, 4))
+    assert pool.stats()["refused"] == 1
+
+    recorder.release.set()
+    pool.close(timeout=5)
+    assert sorted(recorder.handled) == [1, 2, 3]
+
+
+def test_close_drains_queued_updates_and_refuses_new_ones():
+    recorder = Recorder()
+    pool = UpdateWorkerPool(recorder, workers=2)
+    for update_id in range(100):
+        pool.submit(message(update_id % 7, update_id))
+    pool.close(timeout=5)
+
+    assert sorted(recorder.handled) == list(range(100))
+    assert not pool.submit(message(1, 100))
+    assert pool.stats()["queued"] == 0
+
+
+def test_users_are_processed_concurrently():
+    recorder = Recorder()
+    recorder.release.clear()
+    pool = UpdateWorkerPool(recorder, workers=2)
+    pool.submit(message(1, 1))  # holds one worker
+    pool.submit(message(2, 2))
+    deadline = time.monotonic() + 5
+    while pool.stats()["processing"] < 2 and time.monotonic() < deadline:
+        pass
+
+    assert pool.stats()["processing"] == 2  # the other user isn't blocked behind the first one
+    recorder.release.set()
+    pool.close(timeout=5)